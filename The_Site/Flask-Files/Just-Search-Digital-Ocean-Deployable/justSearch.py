@@ -1,18 +1,17 @@
 import os
 import re
 import numpy as np
-import json
-from nltk.stem import PorterStemmer
-from collections import Counter
-from flask import Flask, jsonify
+from functools import reduce
+from flask import Flask, jsonify, request
 from flask_cors import CORS
-from math import log
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy import func
-from sqlalchemy.orm.exc import NoResultFound
-from numpy import dot
-from numpy.linalg import norm
-from models import Page, PageVectors, Term, Bigram, Trigram, ChildLink, TitleIndex, ContentIndex, ContentTermFrequency, TitleBigramIndex, ContentBigramIndex, TitleTrigramIndex, ContentTrigramIndex, DatabaseInfo
+from sqlalchemy.exc import OperationalError
+from analyzer import Analyzer, loadStopwords
+from postings import decodePositions, containsPhrase
+from pagebodies import decompressBody
+from searchindex import SearchIndex
+from models import Page, PageBody, Term, ChildLink, TitleTermPosition, ContentTermPosition, ContentTermFrequency
 from flask_talisman import Talisman
 
 # a flask api to handle the searching of the database
@@ -26,81 +25,29 @@ Talisman(app, content_security_policy=None)
 app.debug = debug
 CORS(app)  # for cross-origin requests
 
-# stopword list, imported from a .txt file
-stopwords = []
-with open('stopwords.txt', 'r') as f:
-    for line in f:
-        stopwords.append(line.strip())
+# stopword set, imported from a .txt file, and the analyzer (tokenizer, stopword filter, and cached stemmer) shared with the crawler
+stopwords = loadStopwords('stopwords.txt')
+analyzer = Analyzer(stopwords)
 
 db_path = os.path.abspath("spidey.db")
 app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{db_path}'
 db = SQLAlchemy(app)
 
-# function to take a given query and return the tfidf vector for the query
-# variant of the above function, but for a query instead of a page
-
-
-def tfidfQueryVector(query, session):
-    # get global database info
-    numPages = session.query(DatabaseInfo.num_pages).first()[0]
-    numTerms = session.query(DatabaseInfo.num_terms).first()[0]
-
-    # tokenize, remove stopwords, and stem the query
-    queryTokens = re.findall(r'\b\w+\b', query.lower())
-    # remove stopwords from the query
-    queryTokens = [
-        token for token in queryTokens if token not in stopwords]
-    # stem with porter's
-    ps = PorterStemmer()
-    queryStems = [ps.stem(token) for token in queryTokens]
-    # count frequency of each word, making a list of tuples (the tf of the tf-idf)
-    queryFreq = Counter(queryStems).most_common()
-    # create the query vector
-    queryVector = np.zeros(numTerms)
-    # now to do the query vector
-    for term, freq in queryFreq:
-        # get the tf of the term using the queryFreq
-        tf = freq
-        # get the idf of the term using the get_n
-        # also, if the term is not in the database, then we skip it
-        termExists = session.query(Term.term).filter(Term.term == term).first()
-        if not termExists:
-            continue
-        else:
-            idf = log(numPages / get_n(term, session))
-        tfidf = tf * idf
-        # get the index of the term as the term_id of the term in the database - 1
-        index = session.query(Term.term_id).filter(
-            Term.term == term).first()[0] - 1
-        # set the value of the vector at the index to the tfidf
-        queryVector[index] = tfidf
-    return queryVector
-
-# helper function for the above two - gets the number of pages that contain the given term
-
-
-def get_n(term, session):
-    # get the term_id of the term
-    term_id = session.query(Term.term_id).filter(
-        Term.term == term).one().term_id
-    # get the number of titles and contents that contain the term
-    title_docs = session.query(TitleIndex.page_id).filter(
-        TitleIndex.term_id == term_id).all()
-    content_docs = session.query(ContentIndex.page_id).filter(
-        ContentIndex.term_id == term_id).all()
-    # form lists of the page_ids for each
-    title_docs_ids = [doc[0] for doc in title_docs]
-    content_docs_ids = [doc[0] for doc in content_docs]
-    # remove duplicates and get the length of the union of the two lists
-    tempArray = title_docs_ids + content_docs_ids
-    intersectArray = set(tempArray)
-    n = len(intersectArray)
-    return n
+# the term dictionary, idfs, postings, document norms and pageranks, loaded into memory once at startup (see searchindex.py)
+# so the scoring runs no queries at all - the database is only read for the phrase positions and the results' details
+# (a database made by an older crawler is missing the tables and columns the index is loaded from, and has to be upgraded first)
+with app.app_context():
+    try:
+        searchIndex = SearchIndex(db.session)
+    except OperationalError as error:
+        raise SystemExit("spidey.db is out of date for this version of the search api (" + str(error.orig) +
+                         "), run python justSpidey.py --upgrade on it first")
 
 # function to search based off of the given query
 
 
 # alt route to allow for default number of results
+# the optional ?pagerank= weight (0 to 1, default 0) blends the pages' pageranks into the scores of the pages that match the query
 @app.route('/api/search/<query>', defaults={'numResults': 50})
 @app.route('/api/search/<query>/<int:numResults>/')
 def search(query="test", numResults=50):
@@ -108,160 +55,98 @@ def search(query="test", numResults=50):
         # check that the query is not empty and not just whitespace
         if query == None or query.isspace():
             return jsonify({'status': 'error', 'message': 'Empty query'}), 400
+        pageRankWeight = request.args.get('pagerank', 0.0, type=float)
+        if not 0 <= pageRankWeight <= 1:
+            return jsonify({'status': 'error', 'message': 'pagerank weight must be between 0 and 1'}), 400
 
         session = db.session  # double check if this is the correct session
-        # preprocess the query string for the search
-        queryTokens = re.findall(r'\b\w+\b', query.lower())
-        # remove stopwords from the query
-        queryTokens = [
-            token for token in queryTokens if token not in stopwords]
-        # stem the query
-        ps = PorterStemmer()
 
         # get an array of the words in the query to iterate through
         searchPhrases = extractPhrases(query)
-        # check that the phrases are not too long & do not contain other phrases
+        # check that the phrases do not contain other phrases
         for phrase in searchPhrases:
-            if len(phrase.split()) > 3:
-                return jsonify({'status': 'error', 'message': f'Phrase: {phrase} too long please reduce to 3 words or less'}), 400
             for otherPhrase in searchPhrases:
                 if phrase != otherPhrase and phrase in otherPhrase:
                     return jsonify({'status': 'error', 'message': f'Phrase: {phrase} is nested within another phrase: {otherPhrase}'}), 400
 
         # remove stopwords and stem the phrases
         for i in range(len(searchPhrases)):
-            phraseTokens = re.findall(r'\b\w+\b', searchPhrases[i].lower())
-            phraseTokens = [
-                token for token in phraseTokens if token not in stopwords]
-            ps = PorterStemmer()
-            phraseStems = [ps.stem(token) for token in phraseTokens]
-            searchPhrases[i] = ' '.join(phraseStems)
-
-        # for each phrase in the query, get the phraseID and add it to the processedSearchPhrases list (phraseID is the trigramID if the phrase is a trigram, bigramID if a bigram, and termID if a unigram)
-        # processedSearchPhrases is a list of tuples (phraseID, phrase, phraseSize)
+            searchPhrases[i] = ' '.join(analyzer.analyze(searchPhrases[i]))
+
+        # for each phrase in the query, find the documents it appears on and add them to the processedSearchPhrases list
+        # processedSearchPhrases is a list of tuples (phraseDocuments, phraseSize)
+        # a phrase that appears on no page at all (or is only stopwords) is left out, as it doesn't tell the pages apart
         processedSearchPhrases = []
         for phrase in searchPhrases:
-            phraseSize = len(phrase.split())
-            try:
-                if phraseSize == 3:
-                    # get the termIDs for the words in the phrase
-                    term1ID = session.query(Term.term_id).filter_by(
-                        term=phrase.split()[0]).one().term_id
-                    term2ID = session.query(Term.term_id).filter_by(
-                        term=phrase.split()[1]).one().term_id
-                    term3ID = session.query(Term.term_id).filter_by(
-                        term=phrase.split()[2]).one().term_id
-                    phraseID = session.query(Trigram.trigram_id).filter_by(
-                        term1_id=term1ID, term2_id=term2ID, term3_id=term3ID).one().trigram_id
-                elif phraseSize == 2:
-                    # get the termIDs for the words in the phrase
-                    term1ID = session.query(Term.term_id).filter_by(
-                        term=phrase.split()[0]).one().term_id
-                    term2ID = session.query(Term.term_id).filter_by(
-                        term=phrase.split()[1]).one().term_id
-                    phraseID = session.query(Bigram.bigram_id).filter_by(
-                        term1_id=term1ID, term2_id=term2ID).one().bigram_id
-                else:
-                    # get the termID for the word in the phrase
-                    termID = session.query(Term.term_id).filter_by(
-                        term=phrase).one().term_id
-                    phraseID = termID
-            except NoResultFound:
-                phraseID = None
-
-            processedSearchPhrases.append((phraseID, phrase, phraseSize))
-
-        # get the tfidf vector for the query as a numpy array
-        queryVector = tfidfQueryVector(query, session)
-
-        # get the database information needed for the search
-        numDocs = session.query(func.count(Page.page_id)).scalar()
-        numTerms = session.query(func.count(Term.term_id)).scalar()
-
-        # calculate the cosine similarity between the query vector and all document vectors
-        docVectors = np.zeros((numDocs, numTerms))
-        docSims = []
-        for i in range(numDocs):
-            docID = i + 1
-            doc = session.query(PageVectors).filter_by(page_id=docID).one()
-            unPickledVector = json.loads(doc.weighted_vector)
-            docVectors[i] = unPickledVector
-            docSims.append((docID,  cosineSimilarity(
-                queryVector, unPickledVector).flatten()[0]))
-
-            # now to check phrases and do weighting for matches within the document
-            # modifiers for title and content weighting is handled with the getWeightedVector function and is already done
-
-            for phraseID, phrase, phraseSize in processedSearchPhrases:
-                if phraseID is not None:
-                    if phraseSize == 3:
-                        # split the phrase into the 3 terms
-                        term1, term2, term3 = phrase.split()
-                        # get the termIDs for the words in the phrase
-                        term1ID = session.query(Term.term_id).filter_by(
-                            term=term1).one().term_id
-                        term2ID = session.query(Term.term_id).filter_by(
-                            term=term2).one().term_id
-                        term3ID = session.query(Term.term_id).filter_by(
-                            term=term3).one().term_id
-                        trigramID = session.query(Trigram.trigram_id).filter_by(
-                            term1_id=term1ID, term2_id=term2ID, term3_id=term3ID).one().trigram_id
-                        # check if the trigram is in the document (if this page_id has this trigram_id)
-                        # we can check both TitleTrigramIndex and ContentTrigramIndex beacuse if its in one its in the document
-                        if session.query(TitleTrigramIndex).filter_by(page_id=docID, trigram_id=trigramID).count() == 0 and session.query(ContentTrigramIndex).filter_by(page_id=docID, trigram_id=trigramID).count() == 0:
-                            docID, docSim = docSims[i]
-                            docSim *= 0.9
-                            docSims[i] = (docID, docSim)
-                        else:
-                            docID, docSim = docSims[i]
-                            docSim *= 1.1
-                            docSims[i] = (docID, docSim)
-                    elif phraseSize == 2:
-                        # split the phrase into the 2 terms
-                        term1, term2 = phrase.split()
-                        # get the termIDs for the words in the phrase
-                        term1ID = session.query(Term.term_id).filter_by(
-                            term=term1).one().term_id
-                        term2ID = session.query(Term.term_id).filter_by(
-                            term=term2).one().term_id
-                        bigramID = session.query(Bigram.bigram_id).filter_by(
-                            term1_id=term1ID, term2_id=term2ID).one().bigram_id
-                        # check if the bigram is in the document (if this page_id has this bigram_id)
-                        # we can check both TitleBigramIndex and ContentBigramIndex beacuse if its in one its in the document
-                        if session.query(TitleBigramIndex).filter_by(page_id=docID, bigram_id=bigramID).count() == 0 and session.query(ContentBigramIndex).filter_by(page_id=docID, bigram_id=bigramID).count() == 0:
-                            docID, docSim = docSims[i]
-                            docSim *= 0.95
-                            docSims[i] = (docID, docSim)
-                        else:
-                            docID, docSim = docSims[i]
-                            docSim *= 1.05
-                            docSims[i] = (docID, docSim)
-                    else:
-                        # get the termID for the word in the phrase
-                        termID = session.query(Term.term_id).filter_by(
-                            term=phrase).one().term_id
-                        # check if the term is in the document (if this page_id has this term_id)
-                        # we can check both TitleIndex and ContentIndex beacuse if its in one its in the document
-                        if session.query(TitleIndex).filter_by(page_id=docID, term_id=termID).count() == 0 and session.query(ContentIndex).filter_by(page_id=docID, term_id=termID).count() == 0:
-                            docID, docSim = docSims[i]
-                            docSim *= 0.975
-                            docSims[i] = (docID, docSim)
-                        else:
-                            docID, docSim = docSims[i]
-                            docSim *= 1.025
-                            docSims[i] = (docID, docSim)
-
-        # sort the document similarities in descending order and get the top numResults
-        sortedSims = sorted(docSims, key=lambda x: x[1], reverse=True)
-        topResults = sortedSims[:numResults]
+            stems = phrase.split()
+            if not stems:
+                continue
+            documents = phraseDocuments(session, stems)
+            if len(documents) > 0:
+                processedSearchPhrases.append((documents, len(stems)))
+
+        # calculate the cosine similarity between the query and all documents, from the in-memory index
+        docSims = searchIndex.similarities(analyzer.analyze(query))
+
+        # now to check phrases and do weighting for matches within the documents
+        # modifiers for title and content weighting are already in the weighted vectors built by the crawler
+        # a page with the phrase (in its title or content) is boosted, and one without it is penalized - more so the longer the phrase
+        for documents, phraseSize in processedSearchPhrases:
+            boost, penalty = phraseWeights[min(phraseSize, 3)]
+            hasPhrase = np.zeros(len(docSims), dtype=bool)
+            hasPhrase[documents] = True
+            docSims *= np.where(hasPhrase, boost, penalty)
+
+        # blend in the pageranks of the pages that match the query, scaled so the highest ranked page has 1 like a perfect match
+        if pageRankWeight > 0 and searchIndex.scaledPageRanks is not None:
+            matched = docSims > 0
+            docSims[matched] = (1 - pageRankWeight) * docSims[matched] + pageRankWeight * searchIndex.scaledPageRanks[matched]
+
+        # get the top numResults (page_id, similarity) pairs, in descending order of similarity
+        topResults = searchIndex.topResults(docSims, numResults)
 
         # convert the top results to JSON and return it
         convertedResults = convertTopResultsToJSON(topResults)
         return jsonify({"pages": convertedResults}), 200
 
 
-def cosineSimilarity(a, b):
-    return dot(a.T, b) / (norm(a) * norm(b))
+# the (boost, penalty) a page gets for having or not having a phrase of 1, 2, or 3+ words
+phraseWeights = {1: (1.025, 0.975), 2: (1.05, 0.95), 3: (1.1, 0.9)}
+
+# how many candidate pages' position lists are loaded per query when checking a phrase
+# (a batch is loaded by its range of page_ids, which the position tables' primary keys are ordered by)
+phraseBatchSize = 5000
+
+# function to find the documents (of the in-memory index) a (stemmed) phrase of any length appears on, in their title or content
+# the documents that have every term of the phrase are found with the index's postings, then the phrase is checked on each
+# of them with the terms' position lists (the terms have to be at consecutive positions in the title or in the content)
+# the candidates are in page_id order, so they are checked in batches, each loading the position lists of a range of page_ids
+def phraseDocuments(session, stems):
+    terms = []
+    for stem in stems:
+        term = searchIndex.termNumber(stem)
+        if term is None:
+            return np.empty(0, dtype=np.int32)
+        terms.append(term)
+
+    candidates = reduce(np.intersect1d, [searchIndex.termDocuments(term) for term in set(terms)])
+    if len(terms) == 1:
+        return candidates
+    termIDs = [term + 1 for term in terms]
+    documents = set()
+    for start in range(0, len(candidates), phraseBatchSize):
+        batchDocuments = candidates[start:start + phraseBatchSize]
+        batch = dict(zip(searchIndex.pageIDs[batchDocuments].tolist(), batchDocuments.tolist()))
+        for positionModel in [TitleTermPosition, ContentTermPosition]:
+            positionLists = {}
+            for pageID, termID, positionList in session.query(positionModel.page_id, positionModel.term_id, positionModel.position_list).filter(
+                    positionModel.page_id.between(min(batch), max(batch)), positionModel.term_id.in_(termIDs)):
+                if pageID in batch:
+                    positionLists.setdefault(pageID, {})[termID] = positionList
+            for pageID, pageLists in positionLists.items():
+                if all(termID in pageLists for termID in termIDs) and containsPhrase([decodePositions(pageLists[termID]) for termID in termIDs]):
+                    documents.add(batch[pageID])
+    return np.array(sorted(documents), dtype=np.int32)
 
 # get the demarcated phrases from the query (marked by double quotes)
 
@@ -279,43 +164,43 @@ def extractPhrases(query):
 # take the top results from the search and convert them to JSON
 # use the id to get the data
 # we need the title, url, last modified date, top 10 keywords and their frequencies, the first 10 child links, and page content
+# the data of all the results is loaded together, with one query for each kind of data rather than one per result
 
 
 def convertTopResultsToJSON(topResults):
     session = db.session
     resultJSONs = []
+    docIDs = [docID for docID, cosSim in topResults]
+    # only the columns shown are read - the pages' raw html is never loaded, and their content is decompressed on its own
+    pages = {page.page_id: page for page in session.query(
+        Page.page_id, Page.title, Page.url, Page.last_modified).filter(Page.page_id.in_(docIDs))}
+    contents = dict(session.query(PageBody.page_id, PageBody.content).filter(PageBody.page_id.in_(docIDs)))
+    # get the top 10 keywords and their frequencies, and the first 10 child links (in the order they are on the page)
+    allTopKeywords = firstRowsPerPage(session.query(ContentTermFrequency.page_id, Term.term, ContentTermFrequency.frequency).join(
+        ContentTermFrequency), ContentTermFrequency.page_id, [ContentTermFrequency.frequency.desc(), ContentTermFrequency.term_id], docIDs)
+    allChildLinks = firstRowsPerPage(session.query(ChildLink.page_id, ChildLink.child_url),
+                                     ChildLink.page_id, [ChildLink.link_id], docIDs)
+
     # get the data needed for the JSON
-    for docID, cosSim in topResults:
-        page = session.query(Page).filter_by(page_id=docID).one()
-        # get the top 10 keywords and their frequencies
-        topKeywords = session.query(Term.term, ContentTermFrequency.frequency).join(ContentTermFrequency).filter(
-            ContentTermFrequency.page_id == docID).order_by(ContentTermFrequency.frequency.desc()).limit(10).all()
+    for docID in docIDs:
+        page = pages[docID]
+        content = decompressBody(contents.get(docID))
 
         # make sure topKeywords is a list of strings
         topKeywords = [(str(keyword[0]), int(keyword[1]))
-                       for keyword in topKeywords]
-
-        # get the first 10 child links
-        childLinks = session.query(ChildLink).filter_by(
-            page_id=docID).limit(10).all()
+                       for keyword in allTopKeywords.get(docID, [])]
 
         # get the urls of the child links as a list for the JSON
-        childLinks = [childLink.child_url for childLink in childLinks]
-
-        lastModified = session.query(
-            Page.last_modified).filter_by(page_id=docID).one()
-
-        # get the last modified date as a string
-        lastModified = lastModified[0]
+        childLinks = [childLink[0] for childLink in allChildLinks.get(docID, [])]
 
         # convert the data to JSON
         pageJSON = {
             "title": page.title,
             "url": page.url,
-            "lastModified": lastModified,
+            "lastModified": page.last_modified,
             "topKeywords": topKeywords,
             "childLinks": childLinks,
-            "content": page.content
+            "content": content
         }
 
         # add the JSON to the list of JSONs
@@ -323,6 +208,16 @@ def convertTopResultsToJSON(topResults):
 
     return resultJSONs
 
+# function to get the first rows (in the given order) of each of the given pages from a query whose first column is the page_id
+# returns a page_id -> list of rows dictionary, the rows without their page_id
+def firstRowsPerPage(query, pageIDColumn, orderBy, pageIDs, limit=10):
+    rowNumber = func.row_number().over(partition_by=pageIDColumn, order_by=orderBy).label('row_number')
+    rows = query.add_columns(rowNumber).filter(pageIDColumn.in_(pageIDs)).subquery()
+    pageRows = {}
+    for row in query.session.query(rows).filter(rows.c.row_number <= limit).order_by(rows.c.row_number):
+        pageRows.setdefault(row[0], []).append(tuple(row[1:-1]))
+    return pageRows
+
 
 # debugging execution
 if debug:
@@ -1,6 +1,6 @@
-from sqlalchemy import Column, Integer, Text, ForeignKey, JSON
+from sqlalchemy import Column, Integer, BigInteger, Float, Text, ForeignKey, LargeBinary, Index
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, deferred
 
 # Seperating out the database models from the actual script
 
@@ -14,25 +14,66 @@ class Page(Base):
 
     page_id = Column(Integer, primary_key=True)
     url = Column(Text)
+    url_fingerprint = Column(BigInteger)
     title = Column(Text)
-    content = Column(Text)
-    raw_html = Column(Text)
     last_modified = Column(Text)
     size = Column(Integer)
     parent_page_id = Column(Integer, ForeignKey('Page.page_id'))
     hash = Column(Text)
+    etag = Column(Text)
+    minhash = Column(LargeBinary)
 
     parent_page = relationship("Page", remote_side=[page_id])
 
-    def __init__(self, url, title, content, raw_html, last_modified, size, parent_page_id, hash):
+    # pages are looked up by the 64 bit fingerprint of their (canonical) url, which is much smaller to index than the url itself
+    __table_args__ = (Index('ix_Page_url_fingerprint', 'url_fingerprint', unique=True),)
+
+    def __init__(self, url, title, last_modified, size, parent_page_id, hash, etag=None, url_fingerprint=None, minhash=None):
         self.url = url
+        self.url_fingerprint = url_fingerprint
+        self.minhash = minhash
         self.title = title
-        self.content = content
-        self.raw_html = raw_html
         self.last_modified = last_modified
         self.size = size
         self.parent_page_id = parent_page_id
         self.hash = hash
+        self.etag = etag
+
+# define the PageAlias model - a url whose page was a near duplicate of an indexed page when it was crawled
+# it isn't indexed itself, and links to it are resolved to the page it duplicates (page_id)
+class PageAlias(Base):
+    __tablename__ = 'PageAlias'
+
+    alias_id = Column(Integer, primary_key=True)
+    url = Column(Text)
+    url_fingerprint = Column(BigInteger)
+    page_id = Column(Integer, ForeignKey('Page.page_id'))
+
+    page = relationship("Page", foreign_keys=[page_id])
+
+    __table_args__ = (Index('ix_PageAlias_url_fingerprint', 'url_fingerprint', unique=True),)
+
+    def __init__(self, url, url_fingerprint, page_id):
+        self.url = url
+        self.url_fingerprint = url_fingerprint
+        self.page_id = page_id
+
+# define the PageBody model - a page's text content and raw html, kept out of the Page table so it stays small and fast to read
+# the bodies are compressed (see pagebodies.py) and deferred, so they are only loaded when they are asked for
+# content_length is the length of the uncompressed content, so it can be averaged without decompressing every page
+class PageBody(Base):
+    __tablename__ = 'PageBody'
+
+    page_id = Column(Integer, ForeignKey('Page.page_id'), primary_key=True)
+    content = deferred(Column(LargeBinary))
+    raw_html = deferred(Column(LargeBinary))
+    content_length = Column(Integer)
+
+    def __init__(self, page_id, content, raw_html, content_length):
+        self.page_id = page_id
+        self.content = content
+        self.raw_html = raw_html
+        self.content_length = content_length
 
 # define the ParentLink model
 class ParentLink(Base):
@@ -61,6 +102,9 @@ class ChildLink(Base):
     page = relationship("Page", foreign_keys=[page_id])
     child_page = relationship("Page", foreign_keys=[child_page_id])
 
+    # a page's links are looked up by its page_id (for the search results, and the unchanged pages of a recrawl)
+    __table_args__ = (Index('ix_ChildLink_page_id_child_url', 'page_id', 'child_url'),)
+
     def __init__(self, page_id, child_page_id, child_url):
         self.page_id = page_id
         self.child_page_id = child_page_id
@@ -73,6 +117,9 @@ class Term(Base):
     term_id = Column(Integer, primary_key=True)
     term = Column(Text)
 
+    # the search api looks terms up by the term itself
+    __table_args__ = (Index('ix_Term_term', 'term'),)
+
     def __init__(self, term):
         self.term = term
 
@@ -109,12 +156,13 @@ class ContentTermFrequency(Base):
         self.frequency = frequency
 
 # define the TitleTermPosition model
+# the position lists are stored in a compact binary form (see postings.py)
 class TitleTermPosition(Base):
     __tablename__ = 'TitleTermPosition'
 
     page_id = Column(Integer, ForeignKey('Page.page_id'), primary_key=True)
     term_id = Column(Integer, ForeignKey('Term.term_id'), primary_key=True)
-    position_list = Column(Text)
+    position_list = Column(LargeBinary)
 
     page = relationship("Page", foreign_keys=[page_id])
     term = relationship("Term", foreign_keys=[term_id])
@@ -125,12 +173,13 @@ class TitleTermPosition(Base):
         self.position_list = position_list
 
 # define the ContentTermPosition model
+# the position lists are stored in a compact binary form (see postings.py)
 class ContentTermPosition(Base):
     __tablename__ = 'ContentTermPosition'
 
     page_id = Column(Integer, ForeignKey('Page.page_id'), primary_key=True)
     term_id = Column(Integer, ForeignKey('Term.term_id'), primary_key=True)
-    position_list = Column(Text)
+    position_list = Column(LargeBinary)
 
     page = relationship("Page", foreign_keys=[page_id])
     term = relationship("Term", foreign_keys=[term_id])
@@ -250,21 +299,54 @@ class ContentTrigramIndex(Base):
         self.trigram_id = trigram_id
 
 # define the model for the PageVectors table
+# the vectors are stored sparsely in a binary form (see vectors.py), along with the norm of the weighted vector
 class PageVectors(Base):
     __tablename__ = 'PageVectors'
 
     page_id = Column(Integer, ForeignKey('Page.page_id'), primary_key=True)
-    title_vector = Column(JSON, nullable=False)
-    content_vector = Column(JSON, nullable=False)
-    weighted_vector = Column(JSON, nullable=False)
+    title_vector = Column(LargeBinary, nullable=False)
+    content_vector = Column(LargeBinary, nullable=False)
+    weighted_vector = Column(LargeBinary, nullable=False)
+    weighted_norm = Column(Float)
 
     page = relationship("Page", foreign_keys=[page_id])
 
-    def __init__(self, page_id, title_vector, content_vector, weighted_vector):
+    def __init__(self, page_id, title_vector, content_vector, weighted_vector, weighted_norm=None):
         self.page_id = page_id
         self.title_vector = title_vector
         self.content_vector = content_vector
         self.weighted_vector = weighted_vector
+        self.weighted_norm = weighted_norm
+
+# define the model for the document frequency (number of pages containing the term in their title or content) and idf of each term
+# computed in one pass once a crawl is finished, so the vectors and queries don't have to count pages per term
+class TermDocumentFrequency(Base):
+    __tablename__ = 'TermDocumentFrequency'
+
+    term_id = Column(Integer, ForeignKey('Term.term_id'), primary_key=True)
+    document_frequency = Column(Integer)
+    idf = Column(Float)
+
+    term = relationship("Term", foreign_keys=[term_id])
+
+    def __init__(self, term_id, document_frequency, idf):
+        self.term_id = term_id
+        self.document_frequency = document_frequency
+        self.idf = idf
+
+# define the model for the pagerank of each page over the link graph (ParentLink and the resolved ChildLinks)
+# computed once a crawl is finished, the ranks of all the pages sum to 1
+class PageRank(Base):
+    __tablename__ = 'PageRank'
+
+    page_id = Column(Integer, ForeignKey('Page.page_id'), primary_key=True)
+    rank = Column(Float)
+
+    page = relationship("Page", foreign_keys=[page_id])
+
+    def __init__(self, page_id, rank):
+        self.page_id = page_id
+        self.rank = rank
 
 # define the model for overall database information
 class DatabaseInfo(Base):
@@ -285,3 +367,40 @@ class DatabaseInfo(Base):
         self.num_trigrams = num_trigrams
         self.avg_title_length = avg_title_length
         self.avg_content_length = avg_content_length
+
+# define the model for the crawl frontier's links that didn't fit in memory (only used while crawling)
+class FrontierLink(Base):
+    __tablename__ = 'FrontierLink'
+
+    link_id = Column(Integer, primary_key=True)
+    url = Column(Text)
+    parent_page_id = Column(Integer)
+
+    def __init__(self, url, parent_page_id):
+        self.url = url
+        self.parent_page_id = parent_page_id
+
+# define the model for the in memory part of the crawl frontier as of the last checkpoint (only used while crawling)
+class CheckpointLink(Base):
+    __tablename__ = 'CheckpointLink'
+
+    position = Column(Integer, primary_key=True)
+    url = Column(Text)
+    parent_page_id = Column(Integer)
+
+    def __init__(self, position, url, parent_page_id):
+        self.position = position
+        self.url = url
+        self.parent_page_id = parent_page_id
+
+# define the model for the crawl checkpoint, which marks a crawl that can be resumed (only used while crawling)
+class CrawlCheckpoint(Base):
+    __tablename__ = 'CrawlCheckpoint'
+
+    checkpoint_id = Column(Integer, primary_key=True)
+    seed_url = Column(Text)
+    num_visited = Column(Integer)
+
+    def __init__(self, seed_url, num_visited):
+        self.seed_url = seed_url
+        self.num_visited = num_visited
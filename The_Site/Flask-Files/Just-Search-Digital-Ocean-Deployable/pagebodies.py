@@ -0,0 +1,17 @@
+import zlib
+
+# the storage format of the page bodies (the PageBody table's content and raw html), shared by the crawler and the search api
+# (the search api has its own copy of this file, keep the two the same so the bodies are read like they were written)
+
+# a body is stored as its utf-8 text compressed with zlib - page text and html shrink to a fraction of their size,
+# and they are only read back when a search result is shown, so decompressing them is rarely paid for
+
+# function to compress a page's text or raw html for storage
+def compressBody(body):
+    return zlib.compress(body.encode('utf-8'), 6)
+
+# function to decompress a stored page body back into its text
+def decompressBody(stored):
+    if stored is None:
+        return None
+    return zlib.decompress(stored).decode('utf-8')
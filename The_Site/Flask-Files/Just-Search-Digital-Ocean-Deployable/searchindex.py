@@ -0,0 +1,93 @@
+import numpy as np
+from collections import Counter
+from sqlalchemy import select
+from vectors import indexType, weightType, decodeVector
+from models import Term, TermDocumentFrequency, PageVectors, PageRank
+
+# the search api's in-memory inverted index, loaded from the crawler's database once when the api starts
+# (the crawler writes the database between runs of the api, so the api has to be restarted to search a new crawl)
+
+# the documents are the pages with a vector, numbered from 0 in page_id order, and the terms are numbered term_id - 1 like in the vectors
+# the postings are the weighted vectors turned around - every term's documents (ascending) and their weights for it, packed into
+# two flat arrays, with term t's postings at postingStarts[t]:postingStarts[t + 1]
+class SearchIndex:
+    def __init__(self, session):
+        # the term dictionary (stem -> term number), and each term's document frequency and idf (both 0 for a term on no page)
+        self.terms = {term: termID - 1 for termID, term in session.execute(select(Term.term_id, Term.term))}
+        numTerms = max(self.terms.values(), default=-1) + 1
+        self.documentFrequencies = np.zeros(numTerms, np.int64)
+        self.idfs = np.zeros(numTerms)
+        for termID, documentFrequency, idf in session.execute(select(
+                TermDocumentFrequency.term_id, TermDocumentFrequency.document_frequency, TermDocumentFrequency.idf)):
+            self.documentFrequencies[termID - 1] = documentFrequency
+            self.idfs[termID - 1] = idf
+
+        # the documents and their norms (precomputed by the crawler)
+        rows = session.execute(select(PageVectors.page_id, PageVectors.weighted_vector,
+                                      PageVectors.weighted_norm).order_by(PageVectors.page_id)).all()
+        vectors = [decodeVector(row.weighted_vector) for row in rows]
+        self.pageIDs = np.array([row.page_id for row in rows], np.int64)
+        self.norms = np.array([row.weighted_norm for row in rows], np.float64)
+
+        # turn the vectors into the postings - sorting the entries by term (stably) keeps each term's documents in order
+        documents = np.repeat(np.arange(len(vectors), dtype=np.int32), [len(indices) for indices, weights in vectors])
+        termNumbers = np.concatenate([np.empty(0, indexType)] + [indices for indices, weights in vectors])
+        weights = np.concatenate([np.empty(0, weightType)] + [weights for indices, weights in vectors])
+        order = np.argsort(termNumbers, kind='stable')
+        self.postingDocuments = documents[order]
+        self.postingWeights = weights[order]
+        self.postingStarts = np.zeros(numTerms + 1, np.int64)
+        np.cumsum(np.bincount(termNumbers, minlength=numTerms)[:numTerms], out=self.postingStarts[1:])
+
+        # the pageranks of the documents, scaled so the highest ranked page has 1 (None if there are no pageranks)
+        pageRanks = dict(session.execute(select(PageRank.page_id, PageRank.rank)).all())
+        ranks = np.array([pageRanks.get(pageID) or 0 for pageID in self.pageIDs.tolist()], np.float64)
+        maxRank = ranks.max(initial=0)
+        self.scaledPageRanks = ranks / maxRank if maxRank > 0 else None
+
+    # function to get the number of a term, or None if it is on no page
+    def termNumber(self, stem):
+        term = self.terms.get(stem)
+        if term is None or self.documentFrequencies[term] == 0:
+            return None
+        return term
+
+    # function to get the (ascending) documents a term is on, in their title or content
+    # a term with an idf of 0 has no postings (the vectors only store nonzero weights), but it is on every page
+    def termDocuments(self, term):
+        start, end = self.postingStarts[term], self.postingStarts[term + 1]
+        if start == end and self.documentFrequencies[term] > 0:
+            return np.arange(len(self.pageIDs), dtype=np.int32)
+        return self.postingDocuments[start:end]
+
+    # function to get the cosine similarity of a query (its list of stems) with every document, as an array of scores
+    # the query's tf-idf weights are added onto the scores of the documents in each of its terms' postings, so only those are touched
+    # (a query with no terms on any page, and a document with an empty vector, has a similarity of 0)
+    def similarities(self, queryStems):
+        scores = np.zeros(len(self.pageIDs))
+        queryWeights = []
+        for term, freq in sorted((self.terms[stem], freq) for stem, freq in Counter(queryStems).items() if stem in self.terms):
+            weight = freq * self.idfs[term]
+            if weight == 0:
+                continue
+            queryWeights.append(weight)
+            start, end = self.postingStarts[term], self.postingStarts[term + 1]
+            scores[self.postingDocuments[start:end]] += weight * self.postingWeights[start:end]
+        queryNorm = np.linalg.norm(queryWeights)
+        if queryNorm == 0:
+            return scores
+        return np.divide(scores, queryNorm * self.norms, out=np.zeros_like(scores), where=self.norms > 0)
+
+    # function to get the top (page_id, score) results from the documents' scores - highest first, ties in page_id order
+    # only the documents that could be in the top are sorted, the rest (with scores of 0) fill in if too few documents scored
+    def topResults(self, scores, count):
+        if count <= 0:
+            return []
+        matched = np.flatnonzero(scores > 0)
+        if len(matched) > count:
+            threshold = np.partition(scores[matched], len(matched) - count)[len(matched) - count]
+            matched = matched[scores[matched] >= threshold]
+        ranked = matched[np.argsort(-scores[matched], kind='stable')][:count]
+        if len(ranked) < count:
+            ranked = np.concatenate((ranked, np.flatnonzero(scores <= 0)[:count - len(ranked)]))
+        return [(int(self.pageIDs[document]), float(scores[document])) for document in ranked]
@@ -0,0 +1,26 @@
+import numpy as np
+
+# the storage format of the PageVectors, shared by the crawler and the search api
+# (this is the search api's copy of the crawler's vectors.py, keep the format the same in both so the vectors are read like they were written
+# - only the crawler's copy reads the JSON vectors of older crawlers, which justSpidey.py --upgrade re-encodes before the api can load them)
+
+# a vector is stored sparsely, as the int32 indices (term_id - 1) of its nonzero weights followed by the float32 weights
+# themselves, both little endian - so a page only takes 8 bytes per distinct term on it, and an empty vector takes none
+indexType = np.dtype('<i4')
+weightType = np.dtype('<f4')
+
+# function to encode a sparse vector, given as the arrays of its nonzero indices and their weights, into its binary form
+def encodeVector(indices, weights):
+    return np.asarray(indices, indexType).tobytes() + np.asarray(weights, weightType).tobytes()
+
+# function to get the norm of a sparse vector's weights, as they are stored
+def vectorNorm(weights):
+    weights = np.asarray(weights, weightType).astype(np.float64)
+    return float(np.sqrt(np.dot(weights, weights)))
+
+# function to decode a stored vector into its (indices, weights) arrays
+def decodeVector(stored):
+    length = len(stored) // (indexType.itemsize + weightType.itemsize)
+    indices = np.frombuffer(stored, indexType, length)
+    weights = np.frombuffer(stored, weightType, length, indexType.itemsize * length)
+    return indices, weights
@@ -0,0 +1,36 @@
+import re
+from functools import lru_cache
+from nltk.stem import PorterStemmer
+
+# the text analysis shared by the crawler and the search api - tokenize, remove stopwords, and stem with porter's
+# (the search api has its own copy of this file, keep the two the same so queries are analyzed like the pages were)
+
+tokenPattern = re.compile(r'\b\w+\b')
+
+# function to read the stopword set from a .txt file (one word per line)
+def loadStopwords(path='stopwords.txt'):
+    with open(path, 'r') as f:
+        return frozenset(line.strip() for line in f)
+
+# the analyzer keeps one stemmer for the whole run, with a bounded cache of stems in front of it
+# (words repeat heavily across pages, so most of the stemming is answered from the cache)
+class Analyzer:
+    def __init__(self, stopwords, stemCacheSize=100000):
+        self.stopwords = frozenset(stopwords)
+        self.stemmer = PorterStemmer()
+        self.stem = lru_cache(maxsize=stemCacheSize)(self.stemmer.stem)
+
+    # lower case the text and split it into tokens, without the stopwords
+    def tokenize(self, text):
+        return [token for token in tokenPattern.findall(text.lower()) if token not in self.stopwords]
+
+    # turn a text into its list of stems, in order
+    def analyze(self, text):
+        stem = self.stem
+        return [stem(token) for token in self.tokenize(text)]
+
+    # analyze many texts at once, stemming each distinct token of the batch only once
+    def analyzeMany(self, texts):
+        tokenLists = [self.tokenize(text) for text in texts]
+        stems = {token: self.stem(token) for token in set().union(*tokenLists)}
+        return [[stems[token] for token in tokens] for tokens in tokenLists]
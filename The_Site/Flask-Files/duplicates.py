@@ -0,0 +1,67 @@
+import hashlib
+import numpy as np
+
+# near duplicate page detection for the crawler - pages that differ only by a date, a session token, or the like
+# (which the exact content hash misses) are caught by comparing minhash signatures of their content
+
+# the features of a page are its distinct shingles (runs of shingleSize consecutive stems), and how near two pages are is
+# the jaccard similarity of their shingle sets (the share of the shingles in either that are in both)
+# a minhash signature holds, for each of numHashes hash functions, the smallest hash of any of the page's shingles -
+# two pages agree on each of them with a chance equal to their jaccard similarity, so the share of the signature they
+# agree on estimates it (and a page that only differs from another by a few words agrees on nearly all of it)
+shingleSize = 3
+numHashes = 64
+# each hash function is the shingle's 64 bit hash xored with a mask and multiplied by an odd number, keeping the top 32 bits
+# (fixed, so signatures stored by one crawl can be compared with those of the next)
+generator = np.random.default_rng(4321)
+hashMasks = generator.integers(0, 1 << 63, numHashes, dtype=np.uint64)
+hashMultipliers = generator.integers(0, 1 << 63, numHashes, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+signatureType = np.dtype('<u4')
+
+# the signatures are split into bands of bandSize hashes for the lsh lookup table - pages that agree on a whole band are
+# the candidates checked, which finds pages with a jaccard similarity of 0.7 or more almost surely (and 0.5 often)
+bandSize = 4
+numBands = numHashes // bandSize
+
+# function to compute the minhash signature of a page from its content stems (in order), as numHashes 32 bit integers
+# or None for a page without any stems
+def minhash(stems):
+    if not stems:
+        return None
+    shingles = {' '.join(stems[i:i + shingleSize]) for i in range(max(len(stems) - shingleSize + 1, 1))}
+    hashes = np.array([int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), 'little')
+                       for shingle in shingles], dtype=np.uint64)
+    return (((hashes[:, None] ^ hashMasks) * hashMultipliers).min(axis=0) >> np.uint64(32)).astype(signatureType)
+
+# function to encode a signature for storage (and decode a stored one)
+def encodeSignature(signature):
+    return None if signature is None else signature.tobytes()
+
+def decodeSignature(stored):
+    return None if stored is None else np.frombuffer(stored, signatureType)
+
+# the lsh lookup table of the minhash signatures of the indexed pages, for finding a page within maxDistance
+# (1 - jaccard similarity) of a new one - each band has a table from its hashes to the pages with them
+class DuplicateIndex:
+    def __init__(self, maxDistance=0.1):
+        self.minSimilarity = 1 - maxDistance
+        self.tables = [{} for band in range(numBands)]
+        self.signatures = {}
+
+    # add an indexed page's signature
+    def add(self, signature, pageID):
+        self.signatures[pageID] = signature
+        for band, table in enumerate(self.tables):
+            table.setdefault(signature[band * bandSize:(band + 1) * bandSize].tobytes(), []).append(pageID)
+
+    # find the page_id of the indexed page most similar to the signature, as long as it is within maxDistance, or None if there isn't one
+    def find(self, signature):
+        candidates = set()
+        for band, table in enumerate(self.tables):
+            candidates.update(table.get(signature[band * bandSize:(band + 1) * bandSize].tobytes(), ()))
+        nearest = None
+        for pageID in candidates:
+            similarity = np.count_nonzero(signature == self.signatures[pageID]) / numHashes
+            if similarity >= self.minSimilarity and (nearest is None or similarity > nearest[0]):
+                nearest = (similarity, pageID)
+        return None if nearest is None else nearest[1]
@@ -0,0 +1,360 @@
+import re
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from email.utils import formatdate, parsedate
+from urllib.parse import urlparse
+from urllib.robotparser import RobotFileParser
+import requests
+from requests.adapters import HTTPAdapter
+
+# the fetching side of the crawler, split out so pages can be fetched by several workers at once
+
+# pages are fetched with a plain http GET by default, and only handed to a browser when they need javascript to render
+# an empty single page app mount point is a sure sign of a page that is filled in by javascript
+jsMountPoint = re.compile(
+    r'<div[^>]*\bid=["\']?(root|app|__next|__nuxt|svelte)["\']?[^>]*>\s*</div>', re.IGNORECASE)
+# the character set a page declares in its html (<meta charset=...> or <meta http-equiv="Content-Type" content="...; charset=...">)
+metaCharset = re.compile(rb'<meta[^>]+charset\s*=\s*["\']?\s*([\w.:-]+)', re.IGNORECASE)
+# used to strip a page down to its visible text
+nonTextElements = re.compile(
+    r'<(script|style|noscript)\b.*?</\1>|<[^>]+>', re.IGNORECASE | re.DOTALL)
+
+# function to guess if a page needs javascript to render its content
+def looksJSRendered(html):
+    if jsMountPoint.search(html):
+        return True
+    # a page with scripts but next to no text is most likely filled in by those scripts
+    if re.search(r'<script\b', html, re.IGNORECASE) is None:
+        return False
+    return len(nonTextElements.sub(' ', html).split()) < 20
+
+# function to decode the body of a fetched page into its html
+# without a charset in the Content-Type header requests falls back to ISO-8859-1, so the charset the page declares in its
+# html is used instead (like a browser does), and failing that the one guessed from the body
+def decodePage(response):
+    if 'charset' in response.headers.get('Content-Type', '').lower():
+        return response.text
+    declared = metaCharset.search(response.content[:4096])
+    if declared is not None:
+        try:
+            return response.content.decode(declared.group(1).decode('ascii'), errors='replace')
+        except LookupError:
+            pass
+    return response.content.decode(response.apparent_encoding or 'utf-8', errors='replace')
+
+# the name the crawler goes by, both in its requests and when reading robots.txt
+userAgent = 'Spidey'
+
+# the per host politeness rules for the fetch workers
+# urls waiting to be fetched are kept in a queue per host, and a host is ready when it has fewer than hostConcurrency
+# fetches running and at least its delay has passed since its last fetch started (hostDelay, or longer if its robots.txt asks)
+# an idle worker takes the oldest waiting url from whichever host is ready, so one slow or throttled host doesn't hold the others up
+# until a host's robots.txt has been read (by the worker fetching its first page) only one of its pages is fetched at a time,
+# so no page is fetched from it before its crawl delay is known
+class HostScheduler:
+    def __init__(self, hostConcurrency=2, hostDelay=0.0):
+        self.hostConcurrency = hostConcurrency
+        self.hostDelay = hostDelay
+        self.condition = threading.Condition()
+        self.queues = {}
+        self.active = {}
+        self.delays = {}
+        self.nextStart = {}
+        self.robotsRead = set()
+        self.order = 0
+        self.closed = False
+
+    # queue a url (and the future its page goes to) under its host
+    def put(self, url, future):
+        host = urlparse(url).netloc
+        with self.condition:
+            self.order += 1
+            self.queues.setdefault(host, []).append((self.order, url, future))
+            self.condition.notify()
+
+    # mark a host's robots.txt as read, setting its delay from the robots.txt crawl delay if it has one (never going under hostDelay)
+    # the calling worker is about to fetch from the host, so the host's next fetch can't start until the delay after now
+    def setCrawlDelay(self, host, crawlDelay=None):
+        with self.condition:
+            self.robotsRead.add(host)
+            if crawlDelay is not None:
+                self.delays[host] = max(self.hostDelay, crawlDelay)
+                self.nextStart[host] = max(self.nextStart.get(host, 0), time.monotonic() + self.delays[host])
+            self.condition.notify_all()
+
+    # block until a host is ready, then take its oldest url, returning (host, url, future) or None once closed
+    def take(self):
+        with self.condition:
+            while not self.closed:
+                now = time.monotonic()
+                readyHost = None
+                wait = None
+                for host, queue in self.queues.items():
+                    concurrency = self.hostConcurrency if host in self.robotsRead else 1
+                    if not queue or self.active.get(host, 0) >= concurrency:
+                        continue
+                    startIn = self.nextStart.get(host, 0) - now
+                    if startIn > 0:
+                        if wait is None or startIn < wait:
+                            wait = startIn
+                    elif readyHost is None or queue[0][0] < self.queues[readyHost][0][0]:
+                        readyHost = host
+                if readyHost is not None:
+                    order, url, future = self.queues[readyHost].pop(0)
+                    self.active[readyHost] = self.active.get(readyHost, 0) + 1
+                    self.nextStart[readyHost] = now + \
+                        self.delays.get(readyHost, self.hostDelay)
+                    return readyHost, url, future
+                self.condition.wait(wait)
+            return None
+
+    # mark a host's fetch as finished, freeing up its slot
+    def done(self, host):
+        with self.condition:
+            self.active[host] -= 1
+            self.condition.notify_all()
+
+    # stop handing out urls, returning the futures that were still waiting
+    def close(self):
+        with self.condition:
+            self.closed = True
+            waiting = [future for queue in self.queues.values()
+                       for order, url, future in queue]
+            self.queues.clear()
+            self.condition.notify_all()
+        return waiting
+
+# a cache of the parsed robots.txt of each host, fetched the first time a worker needs it
+class RobotsCache:
+    def __init__(self):
+        self.parsers = {}
+        self.hostLocks = {}
+        self.lock = threading.Lock()
+
+    # get the robots.txt parser for a url's host, fetching it with the given http session if it isn't cached yet
+    def get(self, url, httpSession):
+        parsedUrl = urlparse(url)
+        with self.lock:
+            hostLock = self.hostLocks.setdefault(parsedUrl.netloc, threading.Lock())
+        # only one worker fetches a host's robots.txt, any others wait for it
+        with hostLock:
+            if parsedUrl.netloc not in self.parsers:
+                self.parsers[parsedUrl.netloc] = self.fetchRobots(
+                    parsedUrl.scheme + '://' + parsedUrl.netloc + '/robots.txt', httpSession)
+            return self.parsers[parsedUrl.netloc]
+
+    # fetch and parse a robots.txt, treating a missing one as allowing everything (and a forbidden one as allowing nothing)
+    def fetchRobots(self, robotsUrl, httpSession):
+        parser = RobotFileParser(robotsUrl)
+        try:
+            response = httpSession.get(robotsUrl, timeout=10)
+        except requests.exceptions.RequestException:
+            parser.allow_all = True
+            return parser
+        if response.status_code in (401, 403):
+            parser.disallow_all = True
+        elif response.status_code >= 400:
+            parser.allow_all = True
+        else:
+            parser.parse(response.text.splitlines())
+        return parser
+
+# a pool of fetch workers that feed the (single threaded) parse/index stage of the crawler
+# the workers fetch the upcoming pages of the BFS queue (as the host scheduler allows), and the indexer takes them back out in queue order
+# so the crawl visits exactly the same pages in the same order as a serial crawl - the workers just keep a bounded window of pages ready
+# pages disallowed by their host's robots.txt are skipped
+# mode is 'http' (plain GETs, with the browser only for javascript rendered pages and browserDomains) or 'browser' (every page through the browser)
+# validators maps urls fetched by an earlier crawl to their (last modified date, etag), which are sent as conditional request headers
+# with parseProcesses, each fetched page is also run through parsePage(url, pageSource) in a pool of that many processes
+# (parsing is cpu bound, so it needs processes rather than threads to run on more than one core)
+class FetchPipeline:
+    def __init__(self, makeDriver, workers=1, window=None, mode='http', browserDomains=(), validators=None, hostConcurrency=2, hostDelay=0.0,
+                 parsePage=None, parseProcesses=0):
+        # makeDriver is called once per worker thread that needs a browser, as a webdriver can only be driven by one thread at a time
+        self.makeDriver = makeDriver
+        self.workers = workers
+        self.mode = mode
+        self.browserDomains = set(domain.lower() for domain in browserDomains)
+        if validators is None:
+            validators = {}
+        self.validators = validators
+        # the bounded buffer between the fetch workers and the indexer (pages fetched or being fetched, but not yet indexed)
+        # it is a few times the number of workers (or parse processes) so the workers can move on to other hosts while one is being waited on
+        if window is None:
+            window = max(workers, parseProcesses) * 4
+        self.window = window
+        self.parsePage = parsePage
+        self.parsePool = None
+        if parsePage is not None and parseProcesses > 0:
+            self.parsePool = ProcessPoolExecutor(parseProcesses)
+        self.pending = {}
+        self.scheduler = HostScheduler(hostConcurrency, hostDelay)
+        self.robots = RobotsCache()
+        self.local = threading.local()
+        self.drivers = []
+        self.driversLock = threading.Lock()
+        self.threads = [threading.Thread(target=self.work, daemon=True)
+                        for i in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    # the loop each worker runs, fetching pages from whichever host is ready until the pipeline is closed
+    def work(self):
+        while True:
+            taken = self.scheduler.take()
+            if taken is None:
+                return
+            host, url, future = taken
+            try:
+                if future.set_running_or_notify_cancel():
+                    self.finish(url, future, self.fetchPage(url))
+            finally:
+                self.scheduler.done(host)
+
+    # hand a fetched page on to the indexer as (page source, last modified date, etag, parsed page) or None
+    # the parsed page is None unless it was parsed in the pool - the worker doesn't wait for the parse, so it can go on fetching
+    def finish(self, url, future, fetched):
+        if fetched is None:
+            future.set_result(None)
+            return
+        if fetched[0] is not None and self.parsePool is not None:
+            try:
+                self.parsePool.submit(self.parsePage, url, fetched[0]).add_done_callback(
+                    lambda parsed: self.finishParsed(url, future, fetched, parsed))
+                return
+            except Exception as e:
+                # (the indexer parses the page itself if the pool can't)
+                print("Failed to queue " + url + " for parsing: " + str(e))
+        future.set_result(fetched + (None,))
+
+    # hand a page parsed in the pool on to the indexer, skipping it if it couldn't be parsed
+    def finishParsed(self, url, future, fetched, parsed):
+        try:
+            result = fetched + (parsed.result(),)
+        except Exception as e:
+            print("Failed to parse " + url + ": " + str(e))
+            result = None
+        future.set_result(result)
+
+    # queue a page for the workers, returning the future its result goes to
+    def submit(self, url):
+        future = Future()
+        self.scheduler.put(url, future)
+        return future
+
+    # get the calling worker's driver, making it on first use
+    def getDriver(self):
+        driver = getattr(self.local, 'driver', None)
+        if driver is None:
+            driver = self.makeDriver()
+            self.local.driver = driver
+            with self.driversLock:
+                self.drivers.append(driver)
+        return driver
+
+    # get the calling worker's http session, making it on first use (sessions keep their connections pooled between pages)
+    def getHttpSession(self):
+        httpSession = getattr(self.local, 'httpSession', None)
+        if httpSession is None:
+            httpSession = requests.Session()
+            httpSession.headers['User-Agent'] = userAgent
+            adapter = HTTPAdapter(pool_maxsize=self.workers)
+            httpSession.mount('http://', adapter)
+            httpSession.mount('https://', adapter)
+            self.local.httpSession = httpSession
+        return httpSession
+
+    # function to decide if a page has to go through the browser, either by its domain or by how its html looks
+    def needsBrowser(self, url, html):
+        if self.mode == 'browser' or urlparse(url).hostname in self.browserDomains:
+            return True
+        return looksJSRendered(html)
+
+    # function to make the conditional request headers for a page we have fetched before
+    def conditionalHeaders(self, url):
+        headers = {}
+        lastModified, etag = self.validators.get(url, (None, None))
+        if etag:
+            headers['If-None-Match'] = etag
+        # older crawls stored the browser's date format, which servers won't understand
+        if lastModified and parsedate(lastModified) is not None:
+            headers['If-Modified-Since'] = lastModified
+        return headers
+
+    # fetch a single page on a worker, returning (page source, last modified date, etag) or None if the page could not be fetched
+    # the page source is None if the server says the page hasn't been modified since we last fetched it
+    # the status, last modified date, and (for static pages) the body all come from the one GET
+    # if the browser can't render a page that looks like it needs one, the page is kept as the GET returned it
+    def fetchPage(self, url):
+        try:
+            httpSession = self.getHttpSession()
+            robots = self.robots.get(url, httpSession)
+            crawlDelay = robots.crawl_delay(userAgent)
+            self.scheduler.setCrawlDelay(urlparse(url).netloc, None if crawlDelay is None else float(crawlDelay))
+            if not robots.can_fetch(userAgent, url):
+                raise Exception("Disallowed by robots.txt")
+            response = httpSession.get(
+                url, headers=self.conditionalHeaders(url), timeout=10)
+            if response.status_code == 304:
+                lastModified, etag = self.validators[url]
+                return None, lastModified, etag
+            # check for response errors and toss out the page if we get one
+            if response.status_code >= 400:
+                raise Exception("Response error: " + str(response.status_code))
+            contentType = response.headers.get('Content-Type', 'text/html')
+            if 'html' not in contentType and 'text' not in contentType:
+                raise Exception("Not a web page: " + contentType)
+            # without a Last-Modified header we use the time of the fetch, like the browser's document.lastModified
+            lastModified = response.headers.get(
+                'Last-Modified', formatdate(usegmt=True))
+            pageSource = decodePage(response)
+            if self.needsBrowser(url, pageSource):
+                try:
+                    driver = self.getDriver()
+                    driver.get(url)
+                    pageSource = driver.page_source
+                except Exception as e:
+                    print("Failed to render " + url + " in the browser, using the page as fetched: " + str(e))
+            return pageSource, lastModified, response.headers.get('ETag')
+        except Exception as e:
+            print("Failed to fetch " + url + ": " + str(e))
+            return None
+
+    # hand the upcoming (canonical, in queue order) urls to the workers until the window is full
+    # visited urls are skipped (isVisited checks a url), and at most limit pages are kept in flight so we don't fetch far past the target
+    def prefetch(self, upcomingUrls, isVisited, limit):
+        window = min(self.window, limit)
+        if len(self.pending) >= window:
+            return
+        for url in upcomingUrls:
+            if len(self.pending) >= window:
+                break
+            if url in self.pending or isVisited(url):
+                continue
+            self.pending[url] = self.submit(url)
+
+    # fetch a page ahead of time and wait for it, leaving the result for get() (used to check the seed url)
+    def check(self, url):
+        if url not in self.pending:
+            self.pending[url] = self.submit(url)
+        return self.pending[url].result()
+
+    # get a page for the indexer, waiting on its worker if it was prefetched and fetching it now if it wasn't
+    def get(self, url):
+        future = self.pending.pop(url, None)
+        if future is None:
+            future = self.submit(url)
+        return future.result()
+
+    # stop the workers (dropping any pages fetched past the end of the crawl) and close their drivers
+    def close(self):
+        for future in self.scheduler.close():
+            future.cancel()
+        for thread in self.threads:
+            thread.join()
+        if self.parsePool is not None:
+            self.parsePool.shutdown()
+        self.pending.clear()
+        for driver in self.drivers:
+            driver.close()
@@ -0,0 +1,93 @@
+import hashlib
+from collections import deque
+from sqlalchemy import insert
+from models import FrontierLink, CheckpointLink
+
+# the crawl frontier - the queue of links still to be visited, kept in BFS order
+
+# links are deduplicated as they are pushed (by the fingerprint of their canonical url), so each url is only ever queued once
+# the front of the queue is kept in memory, and once it holds memoryLimit links any more are spilled to the FrontierLink table
+# spilled links are always newer than the ones in memory, so reading them back in id order keeps the queue FIFO
+# at each checkpoint the in memory links are saved to the CheckpointLink table, so together with the spilled links
+# (which are written in the same transaction) the whole frontier can be restored to resume a crawl
+class Frontier:
+    def __init__(self, session, memoryLimit=10000):
+        self.session = session
+        self.memoryLimit = memoryLimit
+        self.queue = deque()
+        # the fingerprints of every url seen so far (queued, spilled, or already visited)
+        self.seen = set()
+        self.numSpilled = 0
+
+    # start a new crawl, clearing out any links left by an earlier crawl of this database
+    def start(self):
+        self.session.query(FrontierLink).delete()
+        self.session.query(CheckpointLink).delete()
+
+    # pick up the frontier as of the last checkpoint, given the url fingerprints of the pages that were already scraped
+    def restore(self, visitedFingerprints):
+        rows = self.session.query(CheckpointLink.url, CheckpointLink.parent_page_id).order_by(
+            CheckpointLink.position).all()
+        self.queue.extend((url, parentID) for url, parentID in rows)
+        spilledUrls = [url for (url,) in self.session.query(FrontierLink.url)]
+        self.numSpilled = len(spilledUrls)
+        self.seen.update(visitedFingerprints)
+        self.seen.update(urlFingerprint(url) for url, parentID in rows)
+        self.seen.update(urlFingerprint(url) for url in spilledUrls)
+
+    # save the in memory part of the queue (the spilled part is already in the database)
+    def checkpoint(self):
+        self.session.query(CheckpointLink).delete()
+        if self.queue:
+            self.session.execute(insert(CheckpointLink), [{'position': position, 'url': url, 'parent_page_id': parentID}
+                                                          for position, (url, parentID) in enumerate(self.queue)])
+
+    def __len__(self):
+        return len(self.queue) + self.numSpilled
+
+    # push the (canonical) links found on a page, skipping the links that have already been seen
+    def extend(self, urls, parentID):
+        spilled = []
+        for url in urls:
+            fingerprint = urlFingerprint(url)
+            if fingerprint in self.seen:
+                continue
+            self.seen.add(fingerprint)
+            if self.numSpilled or spilled or len(self.queue) >= self.memoryLimit:
+                spilled.append({'url': url, 'parent_page_id': parentID})
+            else:
+                self.queue.append((url, parentID))
+        if spilled:
+            self.session.execute(insert(FrontierLink), spilled)
+            self.numSpilled += len(spilled)
+
+    # take the next (url, parentID) off the front of the queue, reading spilled links back in once memory runs dry
+    def pop(self):
+        if not self.queue and self.numSpilled:
+            self.refill()
+        return self.queue.popleft()
+
+    # move the oldest spilled links back into memory
+    def refill(self):
+        rows = self.session.query(FrontierLink.link_id, FrontierLink.url, FrontierLink.parent_page_id).order_by(
+            FrontierLink.link_id).limit(self.memoryLimit).all()
+        self.queue.extend((url, parentID) for linkID, url, parentID in rows)
+        self.session.query(FrontierLink).filter(
+            FrontierLink.link_id <= rows[-1].link_id).delete()
+        self.numSpilled -= len(rows)
+
+    # the urls at the front of the queue (the in memory part), in the order they will be popped
+    def upcoming(self):
+        return (url for url, parentID in self.queue)
+
+    # drop whatever is left in the queue once the crawl is over
+    def clear(self):
+        self.queue.clear()
+        self.session.query(FrontierLink).delete()
+        self.session.query(CheckpointLink).delete()
+        self.numSpilled = 0
+
+# function to get the 64 bit fingerprint of a (canonical) url - the first 8 bytes of its blake2b hash, as a signed integer so sqlite can store it
+# (a set or index of fingerprints takes a fraction of the memory the urls would, and two urls only share one once in ~10^19 pairs)
+def urlFingerprint(url):
+    return int.from_bytes(hashlib.blake2b(url.encode('utf-8'), digest_size=8).digest(), 'little', signed=True)
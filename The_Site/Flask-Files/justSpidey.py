@@ -1,24 +1,26 @@
-from ssl import SSLError
 import sys
+import argparse
 import os
-import re
-import hashlib
 import numpy as np
-import json
-from bs4 import BeautifulSoup
+from functools import lru_cache, partial
+from itertools import chain
 from nltk import ngrams
-from nltk.stem import PorterStemmer
-from collections import deque, Counter
 from urllib.parse import urlparse, urlunparse, urljoin, urlencode, quote, parse_qs
-import requests
 from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.chrome.service import Service
 from math import log
-from sqlalchemy import func, create_engine
+from sqlalchemy import bindparam, event, func, create_engine, insert, inspect, select, text, union, union_all
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.orm.exc import NoResultFound
-from models import Page, PageVectors, Term, Bigram, Trigram, ParentLink, ChildLink, TitleIndex, ContentIndex, TitleTermPosition, ContentTermPosition, TitleTermFrequency, ContentTermFrequency, TitleBigramIndex, ContentBigramIndex, TitleTrigramIndex, ContentTrigramIndex, DatabaseInfo, Base
+from sqlalchemy.exc import OperationalError
+from fetcher import FetchPipeline
+from frontier import Frontier, urlFingerprint
+from duplicates import DuplicateIndex, minhash, encodeSignature, decodeSignature
+from pageparser import parsePage, htmlParsers, defaultHtmlParser
+from vectors import encodeVector, decodeVector, vectorNorm
+from postings import encodePositions, decodePositions
+from pagebodies import compressBody
+from models import Page, PageAlias, PageBody, PageVectors, Term, Bigram, Trigram, ParentLink, ChildLink, TitleIndex, ContentIndex, TitleTermPosition, ContentTermPosition, TitleTermFrequency, ContentTermFrequency, TitleBigramIndex, ContentBigramIndex, TitleTrigramIndex, ContentTrigramIndex, TermDocumentFrequency, PageRank, DatabaseInfo, CrawlCheckpoint, Base
 
 # creating a web scraper with selenium, beautifulsoup, and sqlite to get X pages from the given root url into a database setup for later searching
 
@@ -57,397 +59,389 @@ options = Options()
 options.add_argument('--log-level=3')
 service = Service(driverPath)
 
-# stopword list, imported from a .txt file
-stopwords = []
-with open('stopwords.txt', 'r') as f:
-    for line in f:
-        stopwords.append(line.strip())
 
-
-def triggerScraping(seedUrl, targetVisited):
+# with recrawl, the pages already in the database are refreshed - only the new and changed pages are (re)indexed
+# hostConcurrency and hostDelay are the politeness limits - how many pages are fetched from one host at once, and the seconds between them
+# parseProcesses is the number of processes the fetched pages are parsed and analyzed in (0 parses them in the indexer itself)
+# with bulkLoad, the database is built in bulk loading mode and left compacted, indexed, and analyzed for the search api (see makeAlchemy)
+# with buildNgrams, the Bigram and Trigram tables (and their title and content indexes) are built as well
+# htmlParser is the parser beautifulsoup builds the page trees with (lxml when it is installed, see pageparser.py)
+# a new page within duplicateDistance (1 - the jaccard similarity of their content) of an indexed page is only stored as an alias of it
+# (see duplicates.py), and a negative duplicateDistance indexes every page
+def triggerScraping(seedUrl, targetVisited, workers=1, fetchMode='http', browserDomains=(), frontierMemory=10000, checkpointEvery=50, resume=False, recrawl=False,
+                    hostConcurrency=2, hostDelay=0.0, parseProcesses=0, bulkLoad=False, buildNgrams=False, htmlParser=defaultHtmlParser, duplicateDistance=0.1):
 
     # Check the parameters
     if targetVisited <= 1:
         print("targetVisited must be greater than 1")
         return
-    if targetVisited > 1000:
-        print("targetVisited must be less than or equal to 1000")
-        return
 
-    # check the url
-    try:
-        response = requests.get(seedUrl)
-        response.raise_for_status()
-    except SSLError:
-        print(f"Invalid SSL/TLS certificate for URL: {seedUrl}")
+    if workers < 1:
+        print("workers must be at least 1")
         return
-    except (requests.exceptions.RequestException, requests.exceptions.HTTPError):
-        # Return a 400 Bad Request error if the URL is invalid or the request fails
-        print(f"Invalid URL: {seedUrl}")
+    if checkpointEvery < 1:
+        print("checkpointEvery must be at least 1")
+        return
+    if hostConcurrency < 1:
+        print("hostConcurrency must be at least 1")
+        return
+    if parseProcesses < 0:
+        print("parseProcesses can't be negative")
+        return
+    if resume and recrawl:
+        print("a recrawl can't be resumed, start it again instead")
+        return
+    if htmlParser not in htmlParsers:
+        print("htmlParser must be one of " + ", ".join(htmlParsers))
+        return
+    if duplicateDistance >= 1:
+        print("duplicateDistance must be less than 1")
         return
 
-    visited = set()
-    bfsQueue = deque()
-    driver = webdriver.Chrome(service=service, options=options)
-    # remove to the database file if it already exists
-    if debug:
+    # remove to the database file if it already exists (unless we are resuming or refreshing the crawl in it)
+    if debug and not resume and not recrawl:
         try:
             os.remove('spidey.db')
         except OSError:
             pass
 
     # adding an sqlite3 sqlachemy database
-    session = makeAlchemy()
+    session = makeAlchemy(bulkLoad, recrawl)
+
+    # visited maps the url fingerprint (see frontier.py) of each scraped page to its page_id
+    visited = {}
+    # on a recrawl, knownPages maps the url fingerprint of each page from the earlier crawl to its page_id
+    # and their last modified dates and etags are used to only fetch the pages that have changed
+    knownPages = {}
+    validators = {}
+    if recrawl:
+        for pageID, url, fingerprint, lastModified, etag in session.query(Page.page_id, Page.url, Page.url_fingerprint, Page.last_modified, Page.etag):
+            knownPages[fingerprint] = pageID
+            validators[url] = (lastModified, etag)
+    # the signatures of the pages already indexed (from an earlier or resumed crawl) are what new pages are checked against
+    duplicates = None
+    if duplicateDistance >= 0:
+        duplicates = DuplicateIndex(duplicateDistance)
+        for pageID, signature in session.query(Page.page_id, Page.minhash).filter(Page.minhash.is_not(None)):
+            duplicates.add(decodeSignature(signature), pageID)
+
+    # the fetch workers use plain http, each starting its own chrome driver only if it meets a page that needs one
+    # the pages they fetch are parsed in a pool of parseProcesses processes, so this process only has to write them to the database
+    pipeline = FetchPipeline(lambda: webdriver.Chrome(
+        service=service, options=options), workers, mode=fetchMode, browserDomains=browserDomains, validators=validators,
+        hostConcurrency=hostConcurrency, hostDelay=hostDelay, parsePage=partial(parsePage, htmlParser=htmlParser), parseProcesses=parseProcesses)
+
+    # check the url (the seed page is kept by the pipeline, so this doesn't cost an extra fetch)
+    # a resumed crawl has already visited the seed, so it isn't fetched again (it would never be taken back out of the pipeline)
+    if not resume and pipeline.check(canonicalize(seedUrl)) is None:
+        print(f"Invalid URL: {seedUrl}")
+        session.close()
+        pipeline.close()
+        return
 
     # scrape
     print("Scraping...")
-    scrape(seedUrl, targetVisited, None, bfsQueue, visited, driver, session)
-    session.commit()
+    # the term -> term_id dictionary is kept for the whole run so stems never need to be looked up in the database
+    termDict = loadTermDict(session)
+    frontier = Frontier(session, frontierMemory)
+    if resume:
+        if session.query(CrawlCheckpoint).first() is None:
+            print("No crawl checkpoint found to resume from")
+            session.close()
+            pipeline.close()
+            return
+        # pick up the pages scraped and the frontier as of the last checkpoint
+        visited.update(session.query(Page.url_fingerprint, Page.page_id).all())
+        visited.update(session.query(PageAlias.url_fingerprint, PageAlias.page_id).all())
+        frontier.restore(visited)
+        # anything built after the crawl is rebuilt from scratch once the crawl is done
+        clearDerivedTables(session)
+        print("Resuming crawl from checkpoint at " + str(len(visited)) + " pages")
+    else:
+        frontier.start()
+        session.query(CrawlCheckpoint).delete()
+        session.add(CrawlCheckpoint(seedUrl, 0))
+    indexedPages = scrape(seedUrl, targetVisited, frontier, visited, pipeline,
+                          session, termDict, checkpointEvery, knownPages, duplicates)
     print ("Page data scraped")
 
+    # resolve the links between the pages, now that every page has its page_id
+    resolveLinks(session)
+
     # get overall database information
     pages = session.query(Page).all()
     numPages = len(pages)
     numTerms = session.query(Term).count()
     avgTitleLength = session.query(func.avg(func.length(Page.title))).scalar()
-    avgContentLength = session.query(func.avg(func.length(Page.content))).scalar()
-
-    # generate the bigrams and trigrams
-    print("Generating bigrams and trigrams...")
-    for page in pages:
-        generateBigramsTrigrams(session, page.page_id)
-    session.commit()
-    print("Bigrams and trigrams generated")
+    avgContentLength = session.query(func.avg(PageBody.content_length)).scalar()
+
+    # on a recrawl only the new and changed pages need their bigrams and trigrams rebuilt
+    # every page's vector is rebuilt though, as the idfs change with any page that is added or changed
+    if recrawl:
+        print("Re-indexed " + str(len(indexedPages)) + " new or changed pages")
+        indexedPageIDs = set(indexedPages)
+        rebuildPages = [page for page in pages if page.page_id in indexedPageIDs]
+        session.query(PageVectors).delete()
+    else:
+        rebuildPages = pages
+
+    # generate the bigrams and trigrams (the search api matches phrases with the term positions, so these are optional)
+    # without buildNgrams the tables are cleared out, so they never cover only some of the pages
+    if buildNgrams:
+        # (a recrawl of a database built without them has to build them for every page)
+        if session.query(Bigram).first() is None:
+            rebuildPages = pages
+        print("Generating bigrams and trigrams...")
+        bigramDict, trigramDict = loadNgramDicts(session)
+        for page in rebuildPages:
+            generateBigramsTrigrams(session, page.page_id, bigramDict, trigramDict)
+        session.commit()
+        print("Bigrams and trigrams generated")
+    else:
+        for model in [TitleBigramIndex, ContentBigramIndex, TitleTrigramIndex, ContentTrigramIndex, Bigram, Trigram]:
+            session.query(model).delete()
 
     # get the number of bigrams and trigrams
     numBigrams = session.query(Bigram).count()
     numTrigrams = session.query(Trigram).count()
 
+    # count the document frequency of every term (all of them change as pages are added or re-indexed)
+    idfs = computeDocumentFrequencies(session, numPages)
+
     # precompute the vectors
     print("Precomputing vectors...")
-    preConstructVectors(session, pages)
+    preConstructVectors(session, pages, idfs)
     session.commit()
     print("Vectors precomputed")
 
-    # add the database information to the database
+    # rank the pages over the whole link graph (new links anywhere change every page's rank)
+    print("Computing pageranks...")
+    computePageRanks(session)
+    session.commit()
+    print("Pageranks computed")
+
+    # add the database information to the database (replacing the information from an earlier crawl)
+    session.query(DatabaseInfo).delete()
     databaseInfo = DatabaseInfo(num_pages=numPages, num_terms=numTerms, num_bigrams=numBigrams,
                                 num_trigrams=numTrigrams, avg_title_length=avgTitleLength, avg_content_length=avgContentLength)
     session.add(databaseInfo)
 
-    # close the session and driver
+    # the crawl is finished, so it no longer needs its frontier or checkpoint
+    frontier.clear()
+    session.query(CrawlCheckpoint).delete()
+
+    # close the session and the fetch workers
     session.commit()
     session.close()
-    driver.close()
+    pipeline.close()
+    if bulkLoad:
+        print("Indexing and compacting the database...")
+        finishBulkLoad(session.get_bind())
     print("Scrape complete")
 
+# function to save the crawl's progress - commits the pages scraped since the last checkpoint along with the frontier
+def checkpointCrawl(session, frontier, visited):
+    frontier.checkpoint()
+    session.query(CrawlCheckpoint).update(
+        {CrawlCheckpoint.num_visited: len(visited)})
+    session.commit()
+
+# function to resolve the links between the crawled pages in bulk once a crawl is done
+# each distinct child url not yet resolved is canonicalized and looked up in a url fingerprint -> page_id map of every page (and alias)
+# and all the child links they resolve are updated in a single statement joined against them
+# the ParentLink table is then rebuilt from the resolved child links, so both hold every link between the pages
+# (not only the one each page was found through)
+def resolveLinks(session):
+    pageIDs = dict(session.query(Page.url_fingerprint, Page.page_id).all())
+    pageIDs.update(session.query(PageAlias.url_fingerprint, PageAlias.page_id).all())
+    targets = []
+    for (childUrl,) in session.query(ChildLink.child_url).filter(ChildLink.child_page_id.is_(None)).distinct():
+        pageID = pageIDs.get(urlFingerprint(canonicalize(childUrl)))
+        if pageID is not None:
+            targets.append({'childUrl': childUrl, 'pageID': pageID})
+    session.execute(text('CREATE TEMPORARY TABLE LinkTarget (child_url TEXT PRIMARY KEY, page_id INTEGER)'))
+    if targets:
+        session.execute(text('INSERT INTO LinkTarget (child_url, page_id) VALUES (:childUrl, :pageID)'), targets)
+        session.execute(text('UPDATE "ChildLink" SET child_page_id = (SELECT page_id FROM LinkTarget WHERE LinkTarget.child_url = "ChildLink".child_url) '
+                             'WHERE child_page_id IS NULL AND child_url IN (SELECT child_url FROM LinkTarget)'))
+    session.execute(text('DROP TABLE LinkTarget'))
+
+    session.query(ParentLink).delete()
+    session.execute(insert(ParentLink).from_select(['page_id', 'parent_page_id'], select(ChildLink.child_page_id, ChildLink.page_id).where(
+        ChildLink.child_page_id.is_not(None)).distinct()))
+
+# function to clear everything indexed for a page, so a changed page can be re-indexed in place
+def clearPageIndex(session, pageID):
+    for model in [TitleTermFrequency, ContentTermFrequency, TitleTermPosition, ContentTermPosition, TitleIndex, ContentIndex,
+                  ChildLink, TitleBigramIndex, ContentBigramIndex, TitleTrigramIndex, ContentTrigramIndex, PageVectors]:
+        session.query(model).filter(model.page_id == pageID).delete()
+
+# function to clear the tables built from the scraped pages after the crawl, so they can be rebuilt when a crawl is resumed
+def clearDerivedTables(session):
+    for model in [TitleBigramIndex, ContentBigramIndex, TitleTrigramIndex, ContentTrigramIndex, Bigram, Trigram, TermDocumentFrequency, PageVectors, PageRank, DatabaseInfo]:
+        session.query(model).delete()
+
 # function to take the exisitng database & precalculate the vectors via the TF-IDF algorithm
-# it will do so on a per page basis, and store the vectors in the database
-def preConstructVectors(session, pages):
-    for page in pages:
-        titleVector, contentVector = tfidfVector(session, page.page_id)
-        # currently using default weights for title and content (0.8, 0.2)
-        weightedVector = getWeightedVector(titleVector, contentVector)
-        # now to add the vectors to the database
-        pageVector = PageVectors(page_id=page.page_id, title_vector=json.dumps(
-            titleVector.tolist()), content_vector=json.dumps(contentVector.tolist()), weighted_vector=json.dumps(weightedVector.tolist()))
-        session.add(pageVector)
-
-# function to take a given page, and return the title and content vectors for the page
-def tfidfVector(session, pageID):
-    # fetch the page
-    page = session.query(Page).filter(Page.page_id == pageID).first()
-    title = page.title
-    content = page.content
-
-    # get the number of pages, title terms, and content terms (use titleIndex and contentIndex)
-    numPages = session.query(func.count(Page.page_id)).scalar()
-    numTerms = session.query(func.count(Term.term_id)).scalar()
-
-    # tokenize, remove stopwords, and stem the title and content
-    titleTokens = re.findall(r'\b\w+\b', title.lower())
-    contentTokens = re.findall(r'\b\w+\b', content.lower())
-
-    # remove stopwords from both title and content
-    titleTokens = [
-        token for token in titleTokens if token not in stopwords]
-    contentTokens = [
-        token for token in contentTokens if token not in stopwords]
-
-    # stem with porter's
-    ps = PorterStemmer()
-    titleStems = [ps.stem(token) for token in titleTokens]
-    contentStems = [ps.stem(token) for token in contentTokens]
-
-    # count frequency of each word, making a list of tuples (the tf of the tf-idf)
-    contentFreq = Counter(contentStems).most_common()
-    titleFreq = Counter(titleStems).most_common()
-
-    # create the title and content vectors
-    title_vector = np.zeros(numTerms)
-    content_vector = np.zeros(numTerms)
-
-    # we can use get_n(term) to get the n for a given term and use that to get the idf
-
-    # now to do the title vector
-    for term, freq in titleFreq:
-        # get the tf of the term using the titleFreq
-        tf = freq
-        # get the idf of the term using the get_n
-        if (get_n(term, session) == 0):
-            if (debug):
-                print("term: " + term + " has n = 0")
-            idf = 0
-        else:
-            idf = log(numPages / get_n(term, session))
-        tfidf = tf * idf
-        # get the index of the term as the term_id of the term in the database - 1
-        index = session.query(Term.term_id).filter(
-            Term.term == term).first()[0] - 1
-        # set the value of the vector at the index to the tfidf
-        title_vector[index] = tfidf
-
-    # now to do the content vector
-    for term, freq in contentFreq:
-        # get the tf of the term using the contentFreq
-        tf = freq
-        # get the idf of the term using the get_n
-        if (get_n(term, session) == 0):
-            if (debug):
-                print("term: " + term + " has n = 0")
-            idf = 0
-        else:
-            idf = log(numPages / get_n(term, session))
-        tfidf = tf * idf
-        # get the index of the term as the term_id of the term in the database - 1
-        index = session.query(Term.term_id).filter(
-            Term.term == term).first()[0] - 1
-        # set the value of the vector at the index to the tfidf
-        content_vector[index] = tfidf
-
-    return title_vector, content_vector
-
-# function to take a given query and return the tfidf vector for the query
-# variant of the above function, but for a query instead of a page
-def tfidfQueryVector(query, session):
-    # get global database info
-    numPages = session.query(DatabaseInfo.num_pages).first()[0]
-    numTerms = session.query(DatabaseInfo.num_terms).first()[0]
-
-    # tokenize, remove stopwords, and stem the query
-    queryTokens = re.findall(r'\b\w+\b', query.lower())
-    # remove stopwords from the query
-    queryTokens = [
-        token for token in queryTokens if token not in stopwords]
-    # stem with porter's
-    ps = PorterStemmer()
-    queryStems = [ps.stem(token) for token in queryTokens]
-    # count frequency of each word, making a list of tuples (the tf of the tf-idf)
-    queryFreq = Counter(queryStems).most_common()
-    # create the query vector
-    queryVector = np.zeros(numTerms)
-    # now to do the query vector
-    for term, freq in queryFreq:
-        # get the tf of the term using the queryFreq
-        tf = freq
-        # get the idf of the term using the get_n
-        # also, if the term is not in the database, then we skip it
-        termExists = session.query(Term.term).filter(Term.term == term).first()
-        if not termExists:
-            continue
-        else:
-            idf = log(numPages / get_n(term, session))
-        tfidf = tf * idf
-        # get the index of the term as the term_id of the term in the database - 1
-        index = session.query(Term.term_id).filter(
-            Term.term == term).first()[0] - 1
-        # set the value of the vector at the index to the tfidf
-        queryVector[index] = tfidf
-    return queryVector
-
-# helper function for the above two - gets the number of pages that contain the given term
-def get_n(term, session):
-    # get the term_id of the term
-    term_id = session.query(Term.term_id).filter(
-        Term.term == term).one().term_id
-    # get the number of titles and contents that contain the term
-    title_docs = session.query(TitleIndex.page_id).filter(
-        TitleIndex.term_id == term_id).all()
-    content_docs = session.query(ContentIndex.page_id).filter(
-        ContentIndex.term_id == term_id).all()
-    # form lists of the page_ids for each
-    title_docs_ids = [doc[0] for doc in title_docs]
-    content_docs_ids = [doc[0] for doc in content_docs]
-    # remove duplicates and get the length of the union of the two lists
-    tempArray = title_docs_ids + content_docs_ids
-    intersectArray = set(tempArray)
-    n = len(intersectArray)
-    return n
-
-# function to create a weighted composite vector with title and content vectors
-def getWeightedVector(titleVector, contentVector, titleWeight=0.8, contentWeight=0.2):
-    # Take a weighted average of the title and body vectors to create a composite vector
-    weightedVector = (titleWeight * titleVector) + \
-        (contentWeight * contentVector)
-    # Return the weighted composite vector
-    return weightedVector
+# the vectors of all the given pages are built at once - the term frequency rows are loaded in bulk and weighted as sparse
+# (page_id, term_id, weight) matrices for the whole corpus, which are then split up by page and bulk inserted into the database
+# the weighted vector is the weighted sum of the title and content vectors (currently using default weights of 0.8 and 0.2)
+def preConstructVectors(session, pages, idfs, titleWeight=0.8, contentWeight=0.2):
+    pageIDs = np.array([page.page_id for page in pages], dtype=np.int64)
+    # the idfs as an array indexed by term_id
+    idfArray = np.zeros(max(idfs, default=0) + 1)
+    idfArray[list(idfs.keys())] = list(idfs.values())
+
+    titleMatrix = tfidfMatrix(session, TitleTermFrequency, pageIDs, idfArray)
+    contentMatrix = tfidfMatrix(session, ContentTermFrequency, pageIDs, idfArray)
+    weightedMatrix = addMatrices([titleMatrix, contentMatrix], [titleWeight, contentWeight])
+
+    # split the matrices up into the (sparse) vectors of each page
+    titleVectors = splitMatrix(titleMatrix, pageIDs)
+    contentVectors = splitMatrix(contentMatrix, pageIDs)
+    weightedVectors = splitMatrix(weightedMatrix, pageIDs)
+    rows = []
+    for i, pageID in enumerate(pageIDs.tolist()):
+        weightedIndices, weightedWeights = weightedVectors[i]
+        rows.append({'page_id': pageID, 'title_vector': encodeVector(*titleVectors[i]), 'content_vector': encodeVector(*contentVectors[i]),
+                     'weighted_vector': encodeVector(weightedIndices, weightedWeights), 'weighted_norm': vectorNorm(weightedWeights)})
+    bulkInsert(session, PageVectors, rows)
+
+# function to load a term frequency table (TitleTermFrequency or ContentTermFrequency) for the given pages in bulk
+# and weight it by the idfs, returning the tf-idf matrix as (page_ids, term_ids, weights) arrays sorted by page_id then term_id
+# terms with an idf of 0 (on every page) are left out, as the vectors only store nonzero weights
+def tfidfMatrix(session, frequencyModel, pageIDs, idfArray):
+    rows = loadIntArray(session, select(frequencyModel.page_id, frequencyModel.term_id, frequencyModel.frequency), 3)
+    rows = rows[np.isin(rows[:, 0], pageIDs)]
+    weights = rows[:, 2] * idfArray[rows[:, 1]]
+    keep = weights != 0
+    order = np.lexsort((rows[keep, 1], rows[keep, 0]))
+    return rows[keep, 0][order], rows[keep, 1][order], weights[keep][order]
+
+# function to add up sparse matrices, each scaled by its weight, into one matrix (sorted by page_id then term_id)
+def addMatrices(matrices, scales):
+    pageIDs = np.concatenate([matrix[0] for matrix in matrices])
+    termIDs = np.concatenate([matrix[1] for matrix in matrices])
+    weights = np.concatenate([scale * matrix[2] for matrix, scale in zip(matrices, scales)])
+    # combine the page_id and term_id into a single key, so entries for the same page and term are summed together
+    keySize = int(termIDs.max(initial=0)) + 1
+    keys, inverse = np.unique(pageIDs * keySize + termIDs, return_inverse=True)
+    summed = np.bincount(inverse, weights, len(keys))
+    keep = summed != 0
+    return keys[keep] // keySize, keys[keep] % keySize, summed[keep]
+
+# function to load the rows of a query over integer columns straight into a (rows, width) numpy array
+# (np.array() of the rows themselves is many times slower, as it inspects every row object)
+def loadIntArray(session, statement, width):
+    return np.fromiter(chain.from_iterable(session.execute(statement)), dtype=np.int64).reshape(-1, width)
+
+# function to split a sparse matrix into the vector of each page, as (indices, weights) arrays with index = term_id - 1
+def splitMatrix(matrix, pageIDs):
+    matrixPageIDs, termIDs, weights = matrix
+    starts = np.searchsorted(matrixPageIDs, pageIDs, 'left')
+    ends = np.searchsorted(matrixPageIDs, pageIDs, 'right')
+    return [(termIDs[start:end] - 1, weights[start:end]) for start, end in zip(starts, ends)]
+
+# function to count the number of pages that contain each term (in their title or content) in one aggregate query
+# the document frequencies and idfs are stored in the TermDocumentFrequency table (replacing those of an earlier crawl)
+# and the idfs are returned as a term_id -> idf dictionary for building the vectors
+def computeDocumentFrequencies(session, numPages):
+    pageTerms = union(select(TitleIndex.term_id, TitleIndex.page_id),
+                      select(ContentIndex.term_id, ContentIndex.page_id)).subquery()
+    documentFrequencies = session.execute(select(pageTerms.c.term_id, func.count()).group_by(
+        pageTerms.c.term_id)).all()
+    idfs = {termID: log(numPages / n) for termID, n in documentFrequencies}
+    session.query(TermDocumentFrequency).delete()
+    bulkInsert(session, TermDocumentFrequency, [{'term_id': termID, 'document_frequency': n, 'idf': idfs[termID]}
+                                                for termID, n in documentFrequencies])
+    return idfs
+
+# function to compute the pagerank of every page by power iteration over the link graph, stored in the PageRank table (replacing those of an earlier crawl)
+# the graph is held as numpy arrays of its edges, so each iteration is a single pass over them however many pages there are
+# the rank of pages without any links out (and of the damping) is spread evenly over every page
+def computePageRanks(session, damping=0.85, tolerance=1e-10, maxIterations=100):
+    pageIDs = np.array([pageID for (pageID,) in session.query(Page.page_id).order_by(Page.page_id)], dtype=np.int64)
+    numPages = len(pageIDs)
+    session.query(PageRank).delete()
+    if numPages == 0:
+        return
+    # the edges are from parent to child, each link only once (a page linking to itself is left out)
+    links = union_all(select(ParentLink.parent_page_id, ParentLink.page_id).where(ParentLink.parent_page_id.is_not(None)),
+                      select(ChildLink.page_id, ChildLink.child_page_id).where(ChildLink.child_page_id.is_not(None)))
+    edges = loadIntArray(session, links, 2)
+    edges = edges[(edges[:, 0] != edges[:, 1]) & np.isin(edges, pageIDs).all(axis=1)]
+    # duplicate links are dropped as keys combining the source and target page's index (like addMatrices)
+    keys = np.unique(np.searchsorted(pageIDs, edges[:, 0]) * numPages + np.searchsorted(pageIDs, edges[:, 1]))
+    sources = keys // numPages
+    targets = keys % numPages
+    outDegrees = np.bincount(sources, minlength=numPages)
+    dangling = outDegrees == 0
+    edgeWeights = 1.0 / outDegrees[sources]
+
+    ranks = np.full(numPages, 1.0 / numPages)
+    for _ in range(maxIterations):
+        spread = (1 - damping + damping * ranks[dangling].sum()) / numPages
+        newRanks = damping * np.bincount(targets, ranks[sources] * edgeWeights, numPages) + spread
+        converged = np.abs(newRanks - ranks).sum() < tolerance
+        ranks = newRanks
+        if converged:
+            break
+    bulkInsert(session, PageRank, [{'page_id': int(pageID), 'rank': float(rank)} for pageID, rank in zip(pageIDs, ranks)])
 
 # function to generate the bigrams and trigrams for a given page & add them to the database
-def generateBigramsTrigrams(session, pageID):
-    # start by getting the page's title and content
-    page = session.query(Page).filter_by(page_id=pageID).one()
-    title = page.title
-    content = page.content
-
-    # clean the data up
-    titleTokens = re.findall(r'\b\w+\b', title.lower())
-    contentTokens = re.findall(r'\b\w+\b', content.lower())
-
-    # remove stopwords from both title and content
-    titleTokens = [
-        token for token in titleTokens if token not in stopwords]
-    contentTokens = [
-        token for token in contentTokens if token not in stopwords]
-
-    # stem with porter's
-    ps = PorterStemmer()
-    titleStems = [ps.stem(token) for token in titleTokens]
-    contentStems = [ps.stem(token) for token in contentTokens]
-
-    # get the bigrams and trigrams from the title and content
-    title_bigrams = list(ngrams(titleStems, 2))
-    title_trigrams = list(ngrams(titleStems, 3))
-    content_bigrams = list(ngrams(contentStems, 2))
-    content_trigrams = list(ngrams(contentStems, 3))
-
-    # for each bigram and trigram, add it to the database if it doesn't already exist
-    for bigram in set(title_bigrams + content_bigrams):
-        term1, term2 = bigram
-        term1_id = session.query(Term.term_id).filter_by(
-            term=term1).one().term_id
-        term2_id = session.query(Term.term_id).filter_by(
-            term=term2).one().term_id
-        # check if the bigram already exists
-        bigramExists = session.query(Bigram).filter_by(
-            term1_id=term1_id, term2_id=term2_id).first()
-        # if it doesn't exist, add it to the database
-        if bigramExists is None:
-            newBigram = Bigram(term1_id=term1_id, term2_id=term2_id)
-            session.add(newBigram)
-            session.flush()
-
-    for trigram in set(title_trigrams + content_trigrams):
-        term1, term2, term3 = trigram
-        term1_id = session.query(Term.term_id).filter_by(
-            term=term1).one().term_id
-        term2_id = session.query(Term.term_id).filter_by(
-            term=term2).one().term_id
-        term3_id = session.query(Term.term_id).filter_by(
-            term=term3).one().term_id
-        # check if the trigram already exists
-        trigramExists = session.query(Trigram).filter_by(
-            term1_id=term1_id, term2_id=term2_id, term3_id=term3_id).first()
-        # if it doesn't exist, add it to the database
-        if trigramExists is None:
-            newTrigram = Trigram(
-                term1_id=term1_id, term2_id=term2_id, term3_id=term3_id)
-            session.add(newTrigram)
-            session.flush()
-
-    # loop through the title_bigrams and add them to the TitleBigramIndex for the page
-    # do so for the title_trigrams, content_bigrams, and content_trigrams as well with their tables
-    for bigram in title_bigrams:
-        term1, term2 = bigram
-        term1_id = session.query(Term.term_id).filter_by(
-            term=term1).one().term_id
-        term2_id = session.query(Term.term_id).filter_by(
-            term=term2).one().term_id
-        bigram_id = session.query(Bigram.bigram_id).filter_by(
-            term1_id=term1_id, term2_id=term2_id).one().bigram_id
-        # add the bigram to the TitleBigramIndex
-        newTitleBigramIndex = TitleBigramIndex(
-            page_id=pageID, bigram_id=bigram_id)
-        # check if a matching bigram already exists for the page
-        bigramExists = session.query(TitleBigramIndex).filter_by(
-            page_id=pageID, bigram_id=bigram_id).first()
-        # if it doesn't exist, add it to the database
-        if bigramExists is None:
-            session.add(newTitleBigramIndex)
-            session.flush()
-    
-    for bigram in content_bigrams:
-        term1, term2 = bigram
-        term1_id = session.query(Term.term_id).filter_by(
-            term=term1).one().term_id
-        term2_id = session.query(Term.term_id).filter_by(
-            term=term2).one().term_id
-        bigram_id = session.query(Bigram.bigram_id).filter_by(
-            term1_id=term1_id, term2_id=term2_id).one().bigram_id
-        # add the bigram to the ContentBigramIndex
-        newContentBigramIndex = ContentBigramIndex(
-            page_id=pageID, bigram_id=bigram_id)
-        # check if a matching bigram already exists for the page
-        bigramExists = session.query(ContentBigramIndex).filter_by(
-            page_id=pageID, bigram_id=bigram_id).first()
-        # if it doesn't exist, add it to the database
-        if bigramExists is None:
-            session.add(newContentBigramIndex)
-            session.flush()
-    
-    for trigram in title_trigrams:
-        term1, term2, term3 = trigram
-        term1_id = session.query(Term.term_id).filter_by(
-            term=term1).one().term_id
-        term2_id = session.query(Term.term_id).filter_by(
-            term=term2).one().term_id
-        term3_id = session.query(Term.term_id).filter_by(
-            term=term3).one().term_id
-        trigram_id = session.query(Trigram.trigram_id).filter_by(
-            term1_id=term1_id, term2_id=term2_id, term3_id=term3_id).one().trigram_id
-        # add the trigram to the TitleTrigramIndex
-        newTitleTrigramIndex = TitleTrigramIndex(
-            page_id=pageID, trigram_id=trigram_id)
-        # check if a matching trigram already exists for the page
-        trigramExists = session.query(TitleTrigramIndex).filter_by(
-            page_id=pageID, trigram_id=trigram_id).first()
-        # if it doesn't exist, add it to the database
-        if trigramExists is None:
-            session.add(newTitleTrigramIndex)
-            session.flush()
-    
-    for trigram in content_trigrams:
-        term1, term2, term3 = trigram
-        term1_id = session.query(Term.term_id).filter_by(
-            term=term1).one().term_id
-        term2_id = session.query(Term.term_id).filter_by(
-            term=term2).one().term_id
-        term3_id = session.query(Term.term_id).filter_by(
-            term=term3).one().term_id
-        trigram_id = session.query(Trigram.trigram_id).filter_by(
-            term1_id=term1_id, term2_id=term2_id, term3_id=term3_id).one().trigram_id
-        # add the trigram to the ContentTrigramIndex
-        newContentTrigramIndex = ContentTrigramIndex(
-            page_id=pageID, trigram_id=trigram_id)
-        # check if a matching trigram already exists for the page
-        trigramExists = session.query(ContentTrigramIndex).filter_by(
-            page_id=pageID, trigram_id=trigram_id).first()
-        # if it doesn't exist, add it to the database
-        if trigramExists is None:
-            session.add(newContentTrigramIndex)
-            session.flush()
+def generateBigramsTrigrams(session, pageID, bigramDict, trigramDict):
+    # get the page's title and content term_ids back from the position tables (the page was analyzed when it was scraped)
+    titleTermIDs = loadTermIDs(session, TitleTermPosition, pageID)
+    contentTermIDs = loadTermIDs(session, ContentTermPosition, pageID)
+
+    # get the bigrams and trigrams (as tuples of term_ids) from the title and content, each only once per page
+    title_bigrams = list(dict.fromkeys(ngrams(titleTermIDs, 2)))
+    title_trigrams = list(dict.fromkeys(ngrams(titleTermIDs, 3)))
+    content_bigrams = list(dict.fromkeys(ngrams(contentTermIDs, 2)))
+    content_trigrams = list(dict.fromkeys(ngrams(contentTermIDs, 3)))
+
+    # give any bigrams and trigrams we haven't seen before an id, bulk inserting them
+    addNgrams(session, Bigram, title_bigrams + content_bigrams, bigramDict)
+    addNgrams(session, Trigram, title_trigrams + content_trigrams, trigramDict)
+
+    # add the page's bigrams and trigrams to their title and content index tables
+    bulkInsert(session, TitleBigramIndex, [{'page_id': pageID, 'bigram_id': bigramDict[bigram]}
+                                           for bigram in title_bigrams])
+    bulkInsert(session, ContentBigramIndex, [{'page_id': pageID, 'bigram_id': bigramDict[bigram]}
+                                             for bigram in content_bigrams])
+    bulkInsert(session, TitleTrigramIndex, [{'page_id': pageID, 'trigram_id': trigramDict[trigram]}
+                                            for trigram in title_trigrams])
+    bulkInsert(session, ContentTrigramIndex, [{'page_id': pageID, 'trigram_id': trigramDict[trigram]}
+                                              for trigram in content_trigrams])
 
     # session closed outside for clarity
     if (debug):
         print("Generated bigram and trigram positions for page " + str(pageID))
 
+# the secondary indexes that are only needed once the database is built (for the search api), rather than by the crawl itself
+# in bulk loading mode these are made once the tables are loaded, instead of being kept up to date row by row
+# (except the ChildLink index on a recrawl, which looks up the links of its unchanged pages by their page_id)
+deferredIndexes = list(Term.__table__.indexes) + list(Page.__table__.indexes) + list(ChildLink.__table__.indexes)
+
 # creating an sqlachemcy database
-def makeAlchemy():
+# bulkLoad sets sqlite up for building the database as fast as possible - a write ahead log without syncing it to disk
+# (a crash of the crawler can't corrupt the database, but a crash of the machine could) and a bigger cache
+# and drops the deferred indexes until finishBulkLoad is called
+def makeAlchemy(bulkLoad=False, recrawl=False):
     engine = create_engine("sqlite:///spidey.db")
+    if bulkLoad:
+        event.listen(engine, 'connect', setBulkLoadPragmas)
 
     # Bind the engine to the base class
     Base.metadata.bind = engine
 
     # Create the tables
     Base.metadata.create_all(bind=engine)
+    droppedIndexes = []
+    if bulkLoad:
+        droppedIndexes = [index for index in deferredIndexes if not (recrawl and index.table is ChildLink.__table__)]
+    upgradeDatabase(engine, droppedIndexes)
+    for index in droppedIndexes:
+        index.drop(bind=engine, checkfirst=True)
 
     # create the session (replaces the connection and cursor)
     Session = sessionmaker(bind=engine)
@@ -456,19 +450,185 @@ def makeAlchemy():
     # return the sessionFactory - this is what we will use to make sessions to interact with the database
     return session
 
-# function to hash pages for later comparison (Reserved for page to page in database comparison in the future, like for page updates)
-def hashPage(soup):
-    # Remove unwanted elements
-    for element in soup(["script", "style", "meta"]):
-        element.decompose()
-    # Extract the text content of the page
-    page_content = soup.get_text()
+# function to set the pragmas for bulk loading on each new connection to the database
+def setBulkLoadPragmas(dbapiConnection, connectionRecord):
+    cursor = dbapiConnection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=OFF')
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.execute('PRAGMA cache_size=-262144')
+    cursor.close()
+
+# function to finish building a database in bulk loading mode, leaving a single compact, fully indexed database file for the search api
+def finishBulkLoad(engine):
+    for index in deferredIndexes:
+        index.create(bind=engine, checkfirst=True)
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        # gather the statistics sqlite's query planner uses to pick indexes
+        connection.execute(text('ANALYZE'))
+        # fold the write ahead log back into the database file
+        connection.execute(text('PRAGMA journal_mode=DELETE'))
+        connection.execute(text('VACUUM'))
+    engine.dispose()
+
+# function to bring a database made by an older version of the crawler up to date (create_all only adds missing tables and their indexes, not missing columns or indexes)
+# (the droppedIndexes of a bulk load are left for finishBulkLoad to make)
+def upgradeDatabase(engine, droppedIndexes=()):
+    pageColumns = [column['name'] for column in inspect(engine).get_columns('Page')]
+    if 'etag' not in pageColumns:
+        with engine.begin() as connection:
+            connection.execute(text('ALTER TABLE "Page" ADD COLUMN etag TEXT'))
+    # pages stored before the url fingerprints get theirs filled in, and the index on the full urls they replace is dropped
+    if 'url_fingerprint' not in pageColumns:
+        with engine.begin() as connection:
+            connection.execute(text('ALTER TABLE "Page" ADD COLUMN url_fingerprint BIGINT'))
+            connection.execute(Page.__table__.update().where(Page.page_id == bindparam('pageID')),
+                               [{'pageID': pageID, 'url_fingerprint': urlFingerprint(url)} for pageID, url in connection.execute(select(Page.page_id, Page.url)).all()])
+            connection.execute(text('DROP INDEX IF EXISTS ix_Page_url'))
+    if 'minhash' not in pageColumns:
+        with engine.begin() as connection:
+            connection.execute(text('ALTER TABLE "Page" ADD COLUMN minhash BLOB'))
+    vectorColumns = [column['name'] for column in inspect(engine).get_columns('PageVectors')]
+    if 'weighted_norm' not in vectorColumns:
+        with engine.begin() as connection:
+            connection.execute(text('ALTER TABLE "PageVectors" ADD COLUMN weighted_norm FLOAT'))
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            if index not in droppedIndexes:
+                index.create(bind=engine, checkfirst=True)
+
+    # older crawlers stored the page vectors as dense JSON lists, which are re-encoded in the sparse binary form (a batch of pages at a time)
+    # and the weighted vectors' norms are filled in for any vectors stored without them
+    with engine.begin() as connection:
+        oldPageIDs = [pageID for (pageID,) in connection.execute(
+            text('SELECT page_id FROM "PageVectors" WHERE typeof(weighted_vector) = \'text\' OR weighted_norm IS NULL'))]
+        for start in range(0, len(oldPageIDs), 100):
+            rows = connection.execute(select(PageVectors.page_id, PageVectors.title_vector, PageVectors.content_vector, PageVectors.weighted_vector).where(
+                PageVectors.page_id.in_(oldPageIDs[start:start + 100]))).all()
+            connection.execute(PageVectors.__table__.update().where(PageVectors.page_id == bindparam('pageID')),
+                               [{'pageID': pageID, 'title_vector': encodeVector(*decodeVector(titleVector)), 'content_vector': encodeVector(*decodeVector(contentVector)),
+                                 'weighted_vector': encodeVector(*decodeVector(weightedVector)), 'weighted_norm': vectorNorm(decodeVector(weightedVector)[1])}
+                                for pageID, titleVector, contentVector, weightedVector in rows])
+
+    # older crawlers stored the position lists as text, which are re-encoded in the binary form (a batch of rows at a time)
+    numOldPositionLists = 0
+    for positionModel in [TitleTermPosition, ContentTermPosition]:
+        with engine.begin() as connection:
+            while True:
+                rows = connection.execute(text('SELECT rowid, position_list FROM "' + positionModel.__tablename__ +
+                                               '" WHERE typeof(position_list) = \'text\' LIMIT 10000')).all()
+                if not rows:
+                    break
+                connection.execute(text('UPDATE "' + positionModel.__tablename__ + '" SET position_list = :positionList WHERE rowid = :rowID'),
+                                   [{'rowID': rowID, 'positionList': encodePositions(decodePositions(positionList))} for rowID, positionList in rows])
+                numOldPositionLists += len(rows)
+
+    # older crawlers stored the pages' text and raw html uncompressed in the Page table itself, which are moved into
+    # the PageBody table compressed (a batch of pages at a time) before the old columns are dropped
+    numOldBodies = 0
+    if 'content' in pageColumns:
+        with engine.begin() as connection:
+            lastPageID = 0
+            while True:
+                rows = connection.execute(text('SELECT page_id, content, raw_html FROM "Page" WHERE page_id > :lastPageID AND content IS NOT NULL '
+                                               'ORDER BY page_id LIMIT 100'), {'lastPageID': lastPageID}).all()
+                if not rows:
+                    break
+                connection.execute(insert(PageBody).prefix_with('OR REPLACE'),
+                                   [{'page_id': pageID, 'content': compressBody(content), 'raw_html': compressBody(rawHTML or ''), 'content_length': len(content)}
+                                    for pageID, content, rawHTML in rows])
+                lastPageID = rows[-1][0]
+                numOldBodies += len(rows)
+        # sqlite only drops columns from 3.35 on, older versions just have the old columns emptied
+        try:
+            with engine.begin() as connection:
+                connection.execute(text('ALTER TABLE "Page" DROP COLUMN content'))
+                connection.execute(text('ALTER TABLE "Page" DROP COLUMN raw_html'))
+        except OperationalError:
+            with engine.begin() as connection:
+                connection.execute(text('UPDATE "Page" SET content = NULL, raw_html = NULL'))
+
+    # give the space the old formats took back to the file system
+    if oldPageIDs or numOldPositionLists or numOldBodies:
+        with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+            connection.execute(text('VACUUM'))
+
+    # databases crawled before the document frequencies were stored get them counted from their index
+    # (only finished crawls, which have their DatabaseInfo and no checkpoint - an unfinished one builds them when it is done)
+    session = sessionmaker(bind=engine)()
+    finishedCrawl = session.query(CrawlCheckpoint).first() is None and session.query(DatabaseInfo).first() is not None
+    if finishedCrawl and session.query(TermDocumentFrequency).first() is None and session.query(Page).first() is not None:
+        computeDocumentFrequencies(session, session.query(Page).count())
+        session.commit()
+    # and those crawled before the minhash signatures were stored get them from their content stems, read back from the position lists
+    # (only when the column was just added, as pages without any content stems never get a signature)
+    unhashedPageIDs = []
+    if 'minhash' not in pageColumns:
+        unhashedPageIDs = [pageID for (pageID,) in session.query(Page.page_id).filter(Page.minhash.is_(None))]
+    if unhashedPageIDs:
+        terms = {termID: term for term, termID in loadTermDict(session).items()}
+        for pageID in unhashedPageIDs:
+            signature = minhash([terms[termID] for termID in loadTermIDs(session, ContentTermPosition, pageID)])
+            session.query(Page).filter(Page.page_id == pageID).update({Page.minhash: encodeSignature(signature)})
+        session.commit()
+    # and those crawled before the pageranks were stored get them computed from their links
+    if finishedCrawl and session.query(PageRank).first() is None and session.query(Page).first() is not None:
+        computePageRanks(session)
+        session.commit()
+    session.close()
 
-    page_content = ' '.join(page_content.split())
-    # hash the raw html
-    return hashlib.sha256(page_content.encode('utf-8')).hexdigest()
+# function to load the existing terms into a term -> term_id dictionary (empty for a fresh database)
+def loadTermDict(session):
+    return {term: termID for term, termID in session.query(Term.term, Term.term_id).all()}
+
+# function to give every new term in terms a term_id & bulk insert them into the Term table
+# term_ids are assigned sequentially, as the vectors rely on them being contiguous (index = term_id - 1)
+def addTerms(session, terms, termDict):
+    newTerms = []
+    for term in terms:
+        if term not in termDict:
+            termDict[term] = len(termDict) + 1
+            newTerms.append({'term_id': termDict[term], 'term': term})
+    bulkInsert(session, Term, newTerms)
+
+# function to load the bigram and trigram dictionaries (tuple of term_ids -> bigram_id / trigram_id) from the database
+def loadNgramDicts(session):
+    bigramDict = {(term1, term2): bigramID for bigramID, term1, term2 in session.query(
+        Bigram.bigram_id, Bigram.term1_id, Bigram.term2_id).all()}
+    trigramDict = {(term1, term2, term3): trigramID for trigramID, term1, term2, term3 in session.query(
+        Trigram.trigram_id, Trigram.term1_id, Trigram.term2_id, Trigram.term3_id).all()}
+    return bigramDict, trigramDict
+
+# function to give every new n-gram (a tuple of term_ids) an id & bulk insert them into the Bigram or Trigram table
+def addNgrams(session, model, ngramList, ngramDict):
+    newNgrams = []
+    for ngram in ngramList:
+        if ngram not in ngramDict:
+            ngramDict[ngram] = len(ngramDict) + 1
+            row = {'term' + str(i + 1) + '_id': termID for i, termID in enumerate(ngram)}
+            row[model.__tablename__.lower() + '_id'] = ngramDict[ngram]
+            newNgrams.append(row)
+    bulkInsert(session, model, newNgrams)
+
+# function to insert a list of row dictionaries into the given model's table in a single executemany
+def bulkInsert(session, model, rows):
+    if rows:
+        session.execute(insert(model), rows)
+
+# function to read a page's term_ids back out of a position table (TitleTermPosition or ContentTermPosition), in order
+# the position lists hold the whole analyzed stem stream of the page, so it never has to be analyzed again after scraping
+def loadTermIDs(session, positionModel, pageID):
+    rows = session.query(positionModel.term_id, positionModel.position_list).filter(
+        positionModel.page_id == pageID).all()
+    termIDs = {}
+    for termID, positionList in rows:
+        for position in decodePositions(positionList):
+            termIDs[position] = termID
+    return [termIDs[position] for position in range(len(termIDs))]
 
 # function to canonicalize urls
+# the same links turn up on page after page, so the canonical forms of the most recent ones are kept rather than worked out again
+@lru_cache(maxsize=100000)
 def canonicalize(url, base_url=None):
     # Canonicalizes a URL by performing the following operations:
     # 1. Normalizes the scheme and hostname to lower case.
@@ -534,229 +694,218 @@ def canonicalize(url, base_url=None):
         path='/'.join(filter(None, parsed_url.path.split('/'))))
     return urlunparse(parsed_url)
 
-# function to try and get the page, skipping if it fails due to verification or timeout, exits the program if we've run out of links early
-def getPage(curUrl, bfsQueue, visited, driver):
-    try:
-        # get the page with selenium, with a 10 second timeout
-        driver.get(curUrl)
-        # check for response errors and toss out the page if we get one
-        response = requests.head(curUrl)
-        if response.status_code < 200 and response.status_code >= 300:
-            raise Exception("Response error: " + str(response.status_code))
-        return
-    except Exception as e:
-        # if there's nothing in the queue, except the code and end the program
-        if len(bfsQueue) == 0:
-            print("No more links to visit, as the last one has excepted. Exiting...")
-            exit()
-        else:
-            # if there is something else in the queue, move on to that
-            nextLink = bfsQueue.popleft()
-            while nextLink is None or nextLink in visited:
-                if len(bfsQueue) == 0:
-                    print(
-                        "No more links to visit, as the last one has excepted. Exiting...")
-                    exit()
-                nextLink = bfsQueue.popleft()
-            return getPage(nextLink, bfsQueue, visited, driver)
+# function to hand the front of the frontier to the fetch workers, in queue order
+def prefetchFrontier(pipeline, frontier, visited, targetVisited):
+    pipeline.prefetch(frontier.upcoming(), lambda url: urlFingerprint(url) in visited, targetVisited - len(visited))
 
 # from each page, we need to get the page title, page url, last modification date, size of page (in characters)
 # and the first 10 links on the page, as well as top 10 keywords along with their frequency
 
-# the function to recursively scrape the pages
-def scrape(curUrl, targetVisited, parentID, bfsQueue, visited, driver, session):
+# the function to scrape the pages in a breadth-first manner, until we reach the target number of pages or we run out of pages to scrape
+# the frontier keeps track of the pages to scrape (each link only once), and visited keeps track of the pages we have already scraped
+# the crawl is checkpointed every checkpointEvery pages, which is also when the scraped pages are committed
+# knownPages holds the pages from an earlier crawl when recrawling, and the page_ids of the pages that were (re)indexed are returned
+# duplicates is the DuplicateIndex new pages are checked against (None to index every page)
+def scrape(seedUrl, targetVisited, frontier, visited, pipeline, session, termDict, checkpointEvery=50, knownPages={}, duplicates=None):
+    frontier.extend([canonicalize(seedUrl)], None)
+    indexedPages = []
+
+    while frontier and len(visited) < targetVisited:
+        curUrl, parentID = frontier.pop()
+        # keep the workers busy on the next pages in the frontier while this one is indexed
+        prefetchFrontier(pipeline, frontier, visited, targetVisited)
+
+        scraped = scrapePage(curUrl, parentID, pipeline,
+                             session, termDict, knownPages.get(urlFingerprint(curUrl)), duplicates)
+        if scraped is None:
+            continue
+        pageID, links, indexed = scraped
+        visited[urlFingerprint(curUrl)] = pageID
+        if indexed:
+            indexedPages.append(pageID)
+
+        # queue up the links we haven't seen before (the links between the pages are resolved once the crawl is done, see resolveLinks)
+        links = [canonicalize(link) for link in links]
+        frontier.extend(links, pageID)
+        prefetchFrontier(pipeline, frontier, visited, targetVisited)
 
-    # get the parent url (if there is none, then it's the root)
-    curUrl = canonicalize(curUrl)
+        if len(visited) % checkpointEvery == 0:
+            checkpointCrawl(session, frontier, visited)
 
-    # base case
-    if curUrl in visited:
-        # if the curUrl has already been visited, the parentURL should be added to the parent table for this pageID, as found from the curUrl
-        visitPageID = session.query(Page).filter_by(url=curUrl).first().page_id
-        newParentLink = ParentLink(
-            page_id=visitPageID, parent_page_id=parentID)
-        # if this doesn't work as INSERT OR IGNORE, swap to insert + .onconflict_do_nothing()
-        session.merge(newParentLink)
-        return
-    elif len(visited) >= targetVisited:
+        if (debug):
+            print("Remaining pages to scrape: " +
+                  (str(targetVisited - len(visited))))
+            print("BFS Queue length: " + str(len(frontier)))
+
+    if len(visited) >= targetVisited:
         if debug:
             print("Finished scraping " + str(targetVisited) + " pages. Exiting...")
-        return
     else:
-        # get the page
-        getPage(curUrl, bfsQueue, visited, driver)
-        # parse page
-        soup = BeautifulSoup(driver.page_source, 'html.parser')
-        if soup.title is not None and soup.title.string.strip() != "":
-            title = soup.title.string
-        else:
-            title = "No Title Given"
-        rawHTML = driver.page_source
-        hash = hashPage(soup)
-
-        # get last modified date by
-        lastModified = driver.execute_script("return document.lastModified")
-        if lastModified is None:
-            lastModified = driver.execute_script("return document.date")
-            if lastModified is None:
-                lastModified = "Unkown"
-
-        # get the size of the page by getting the length of the raw html
-        size = len(rawHTML)
-
-        # get the links in the page
-        links = []
-        # the use of limiters was causing issues with the links
-        for link in soup.find_all('a'):
-            href = link.get('href')
-            # previously checked for href.startswith("http") but this was causing issues with relative links
-            if href is not None:
-                links.append(href)
-
-        # if any link within links is a relative link, we need to make it absolute
-        # use the current url as the base with urljoin and replace the link in links
-        for i in range(len(links)):
-            if not links[i].startswith("http"):
-                links[i] = urljoin(curUrl, links[i])
-
-        text = soup.get_text()
-
-        # Tokenize document content and title
-        titleTokens = re.findall(r'\b\w+\b', title.lower())
-        contentTokens = re.findall(r'\b\w+\b', text.lower())
-
-        # remove stopwords from both title and content
-        titleTokens = [
-            token for token in titleTokens if token not in stopwords]
-        contentTokens = [
-            token for token in contentTokens if token not in stopwords]
-
-        # stem with porter's
-        ps = PorterStemmer()
-        titleStems = [ps.stem(token) for token in titleTokens]
-        contentStems = [ps.stem(token) for token in contentTokens]
-
-        # count frequency of each word, making a list of tuples
-        contentFreq = Counter(contentStems).most_common()
-        titleFreq = Counter(titleStems).most_common()
-
+        print("No more pages to scrape, as the frontier is empty. Exiting...")
+    checkpointCrawl(session, frontier, visited)
+    return indexedPages
+
+# the function to scrape a single page into the database, returning its page_id, the links on it, and whether it was (re)indexed
+# (or None if it couldn't be fetched)
+# existingID is the page_id of the page from an earlier crawl when recrawling, which is only re-indexed if its content has changed
+# a new page that is a near duplicate of one in duplicates is only stored as an alias, returning the page_id of the page it duplicates
+def scrapePage(curUrl, parentID, pipeline, session, termDict, existingID=None, duplicates=None):
+    # get the page from the fetch workers, skipping it if it fails due to verification, timeout, or a response error
+    fetched = pipeline.get(curUrl)
+    if fetched is None:
+        return None
+    pageSource, lastModified, etag, parsed = fetched
+    # a page the server says hasn't been modified keeps everything it had, and we carry on with the links it had last time
+    if pageSource is None:
+        links = [childUrl for (childUrl,) in session.query(ChildLink.child_url).filter(
+            ChildLink.page_id == existingID).order_by(ChildLink.link_id)]
+        return existingID, links, False
+    # parse the page here if the pipeline didn't already parse it in its process pool
+    if parsed is None:
+        parsed = pipeline.parsePage(curUrl, pageSource)
+    title, text, links, hash, signature, titlePostings, contentPostings = parsed
+    rawHTML = pageSource
+
+    # get the size of the page by getting the length of the raw html
+    size = len(rawHTML)
+
+    # a page whose content hasn't changed only needs its last modified date, etag, and size updated
+    # along with its links, if they have changed (the hash is only of the page's text, so its links can change without it)
+    if existingID is not None:
+        existingPage = session.get(Page, existingID)
+        existingPage.last_modified = lastModified
+        existingPage.etag = etag
+        if existingPage.hash == hash:
+            existingPage.size = size
+            oldLinks = [childUrl for (childUrl,) in session.query(ChildLink.child_url).filter(
+                ChildLink.page_id == existingID).order_by(ChildLink.link_id)]
+            if oldLinks != links:
+                session.query(ChildLink).filter(ChildLink.page_id == existingID).delete()
+                bulkInsert(session, ChildLink, [{'page_id': existingID, 'child_page_id': None, 'child_url': link}
+                                                for link in links])
+            return existingID, links, False
+    elif duplicates is not None and signature is not None:
+        # a near duplicate isn't indexed (replacing the alias from an earlier crawl, if there is one)
+        originalID = duplicates.find(signature)
+        if originalID is not None:
+            session.execute(insert(PageAlias).prefix_with('OR REPLACE'),
+                            [{'url': curUrl, 'url_fingerprint': urlFingerprint(curUrl), 'page_id': originalID}])
+            return originalID, links, False
+
+    if existingID is None:
         # inserting the page into the Page table with the session
-        newPage = Page(curUrl, title, text, rawHTML,
-                       lastModified, size, parentID, hash)
+        newPage = Page(curUrl, title, lastModified, size, parentID, hash, etag, urlFingerprint(curUrl), encodeSignature(signature))
         session.add(newPage)
         session.flush()
         pageID = newPage.page_id
-
-        # inserting the child links into the ChildLink table (parent links are handled when the child is visited) with the session
-        for link in links:
-            newChildLink = ChildLink(pageID, None, link)
-            session.add(newChildLink)
-
-        # updating the child link table with the parentID when we are working on the child
-        # we find child links with matching parentID as page_id and child_url as curUrl
-        # we then update the child_page_id to be the pageID of the current page
-        # this is done for all child links with the same parentID and curUrl
-        session.query(ChildLink).filter(ChildLink.page_id == parentID,
-                                        ChildLink.child_url == curUrl).update({ChildLink.child_page_id: pageID})
-
-        if (parentID is not None):
-            newParentLink = ParentLink(pageID, parentID)
-            session.add(newParentLink)
-
-        # add each unique term to the Term table
-        for term in set(titleStems + contentStems):
-            try:
-                # attempt to retrieve the term from the database
-                existingTerm = session.query(Term).filter_by(term=term).one()
-            except NoResultFound:
-                # if the term is not found in the database, add it to the session
-                newTerm = Term(term=term)
-                session.add(newTerm)
-
-        # inserting into the content term frequency table
-        for stem, freq in contentFreq:
-            termID = session.query(Term).filter_by(term=stem).one().term_id
-            newTermFreq = ContentTermFrequency(
-                page_id=pageID, term_id=termID, frequency=freq)
-            session.add(newTermFreq)
-
-        # inserting into the title term frequency table
-        for stem, freq in titleFreq:
-            termID = session.query(Term).filter_by(term=stem).one().term_id
-            newTermFreq = TitleTermFrequency(
-                page_id=pageID, term_id=termID, frequency=freq)
-            session.add(newTermFreq)
-
-        # inserting into the ContentTermPosition table
-        for stem, freq in contentFreq:
-            termID = session.query(Term).filter_by(term=stem).one().term_id
-            positions = [i for i, t in enumerate(contentStems) if t == stem]
-            # the list in the database is a string of comma separated integers
-            positionsList = ','.join(str(pos) for pos in positions)
-            newContentTermPosition = ContentTermPosition(
-                page_id=pageID, term_id=termID, position_list=positionsList)
-            session.add(newContentTermPosition)
-
-        # inserting into the TitleTermPosition table
-        for stem, freq in titleFreq:
-            termID = session.query(Term).filter_by(term=stem).one().term_id
-            positions = [i for i, t in enumerate(titleStems) if t == stem]
-            # the list in the database is a string of comma separated integers
-            positionsList = ','.join(str(pos) for pos in positions)
-            newTitleTermPosition = TitleTermPosition(
-                page_id=pageID, term_id=termID, position_list=positionsList)
-            session.add(newTitleTermPosition)
-
-        # inserting into the ContentIndex table
-        for stem, freq in contentFreq:
-            termID = session.query(Term).filter_by(term=stem).one().term_id
-            newContentIndex = ContentIndex(term_id=termID, page_id=pageID)
-            session.add(newContentIndex)
-
-        # inserting into the TitleIndex table
-        for stem, freq in titleFreq:
-            termID = session.query(Term).filter_by(term=stem).one().term_id
-            newTitleIndex = TitleIndex(term_id=termID, page_id=pageID)
-            session.add(newTitleIndex)
-
-        # commit changes to the database
-        session.commit()
-
-        # add to visited set
-        visited.add(curUrl)
-
-        if (debug):
-            print("Remaining pages to scrape: " +
-                  (str(targetVisited - len(visited))))
-            if (bfsQueue):
-                print("BFS Queue length: " + str(len(bfsQueue)))
-
-        # move on to the next page to keep scraping until we reach the target number of pages or we run out of pages to scrape
-        # we are doing so in a breadth-first manner
-        # we will use a queue to keep track of the pages to scrape
-        # we will use a set to keep track of the pages we have already visited (faster than checking the database)
-
-        bfsQueue.extend(link for link in links if link not in visited)
-
-        if not bfsQueue:
-            print("No more pages to scrape at: " + curUrl)
-
-        # start scraping
-        while bfsQueue:
-            nextLink = bfsQueue.popleft()
-            if nextLink not in visited and not None:
-                scrape(nextLink, targetVisited, pageID,
-                       bfsQueue, visited, driver, session)
+        # and its compressed text and raw html into the PageBody table
+        session.add(PageBody(pageID, compressBody(text), compressBody(rawHTML), len(text)))
+        # (a page that was an alias in an earlier crawl, but isn't a near duplicate anymore, is one no longer)
+        session.query(PageAlias).filter(PageAlias.url_fingerprint == newPage.url_fingerprint).delete()
+    else:
+        # a changed page is re-indexed in place, keeping its page_id (and so its place in the other pages' links)
+        pageID = existingID
+        existingPage.title = title
+        existingPage.size = size
+        existingPage.minhash = encodeSignature(signature)
+        session.query(PageBody).filter(PageBody.page_id == pageID).update(
+            {PageBody.content: compressBody(text), PageBody.raw_html: compressBody(rawHTML), PageBody.content_length: len(text)})
+        existingPage.hash = hash
+        clearPageIndex(session, pageID)
+
+    # the pages crawled after this one are checked against it
+    if duplicates is not None and signature is not None:
+        duplicates.add(signature, pageID)
+
+    # inserting the child links into the ChildLink table (their child_page_ids and the parent links are filled in by resolveLinks) with the session
+    bulkInsert(session, ChildLink, [{'page_id': pageID, 'child_page_id': None, 'child_url': link}
+                                    for link in links])
+
+    # make sure every stem on the page has a term_id, bulk inserting any new terms
+    addTerms(session, [stem for stem, positions in titlePostings + contentPostings], termDict)
+
+    # build the per-page rows from the postings using the in-memory term dictionary (no per-stem lookups)
+    # the position lists are stored encoded (see postings.py)
+    contentFreqRows, contentPositionRows, contentIndexRows = [], [], []
+    for stem, positions in contentPostings:
+        termID = termDict[stem]
+        contentFreqRows.append(
+            {'page_id': pageID, 'term_id': termID, 'frequency': len(positions)})
+        contentPositionRows.append({'page_id': pageID, 'term_id': termID,
+                                    'position_list': encodePositions(positions)})
+        contentIndexRows.append({'term_id': termID, 'page_id': pageID})
+    titleFreqRows, titlePositionRows, titleIndexRows = [], [], []
+    for stem, positions in titlePostings:
+        termID = termDict[stem]
+        titleFreqRows.append(
+            {'page_id': pageID, 'term_id': termID, 'frequency': len(positions)})
+        titlePositionRows.append({'page_id': pageID, 'term_id': termID,
+                                  'position_list': encodePositions(positions)})
+        titleIndexRows.append({'term_id': termID, 'page_id': pageID})
+
+    # bulk insert into the frequency, position, and index tables (one statement per table per page)
+    bulkInsert(session, ContentTermFrequency, contentFreqRows)
+    bulkInsert(session, TitleTermFrequency, titleFreqRows)
+    bulkInsert(session, ContentTermPosition, contentPositionRows)
+    bulkInsert(session, TitleTermPosition, titlePositionRows)
+    bulkInsert(session, ContentIndex, contentIndexRows)
+    bulkInsert(session, TitleIndex, titleIndexRows)
+
+    return pageID, links, True
 
 
 # debugging execution
+# (the debug crawl replaces spidey.db, so it refuses to run when asked to only upgrade the database)
 if debug:
+    if '--upgrade' in sys.argv[1:]:
+        sys.exit("debug is set in justSpidey.py, so it would crawl a new spidey.db instead of upgrading it - set debug to False to upgrade")
     seedUrl = 'https://www.cse.ust.hk/~kwtleung/COMP4321/testpage.htm'
     targetVisited = 300
     triggerScraping(seedUrl, targetVisited)
 
 if __name__ == '__main__' and not debug:
-    # get the seed url and target number of pages to scrape from the command line
-    seedUrl = sys.argv[1]
-    targetVisited = int(sys.argv[2])
-    triggerScraping(seedUrl, targetVisited)
+    # get the seed url, target number of pages to scrape, and number of fetch workers from the command line
+    parser = argparse.ArgumentParser()
+    parser.add_argument('seedUrl', nargs='?')
+    parser.add_argument('targetVisited', type=int, nargs='?')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of pages fetched at once')
+    parser.add_argument('--fetch-mode', choices=['http', 'browser'], default='http', dest='fetchMode',
+                        help='http fetches pages with plain GETs and only uses the browser for javascript rendered pages, browser renders every page')
+    parser.add_argument('--browser-domain', action='append', default=[], dest='browserDomains',
+                        help='a domain whose pages are always rendered in the browser (can be repeated)')
+    parser.add_argument('--frontier-memory', type=int, default=10000, dest='frontierMemory',
+                        help='number of queued links kept in memory before the rest are spilled to the database')
+    parser.add_argument('--checkpoint-every', type=int, default=50, dest='checkpointEvery',
+                        help='number of pages between checkpoints of the crawl')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue the crawl in spidey.db from its last checkpoint')
+    parser.add_argument('--recrawl', action='store_true',
+                        help='refresh the crawl in spidey.db, only re-indexing the pages that are new or have changed')
+    parser.add_argument('--host-concurrency', type=int, default=2, dest='hostConcurrency',
+                        help='number of pages fetched from one host at once')
+    parser.add_argument('--host-delay', type=float, default=0.0, dest='hostDelay',
+                        help='seconds between fetches from one host (a longer robots.txt crawl delay wins)')
+    parser.add_argument('--parse-processes', type=int, default=0, dest='parseProcesses',
+                        help='number of processes pages are parsed and analyzed in (0 parses them in the indexer)')
+    parser.add_argument('--bulk-load', action='store_true', dest='bulkLoad',
+                        help='build spidey.db in bulk loading mode, then index, analyze, and compact it for the search api')
+    parser.add_argument('--ngrams', action='store_true', dest='buildNgrams',
+                        help='also build the bigram and trigram tables (phrases are searched with the term positions, so they are optional)')
+    parser.add_argument('--html-parser', choices=htmlParsers, default=defaultHtmlParser, dest='htmlParser',
+                        help='the html parser pages are parsed with (lxml is faster, and the default when it is installed)')
+    parser.add_argument('--duplicate-distance', type=float, default=0.1, dest='duplicateDistance',
+                        help='how near (1 - jaccard similarity) a page must be to an indexed page to be stored as an alias of it instead of indexed (-1 indexes every page)')
+    parser.add_argument('--upgrade', action='store_true',
+                        help='only bring spidey.db up to date with this version of the crawler (e.g. the vector format), without crawling')
+    args = parser.parse_args()
+    if args.upgrade:
+        makeAlchemy().close()
+        print("Database upgraded")
+        sys.exit()
+    if args.seedUrl is None or args.targetVisited is None:
+        parser.error('seedUrl and targetVisited are required unless upgrading')
+    triggerScraping(args.seedUrl, args.targetVisited, workers=args.workers, fetchMode=args.fetchMode, browserDomains=args.browserDomains,
+                    frontierMemory=args.frontierMemory, checkpointEvery=args.checkpointEvery, resume=args.resume, recrawl=args.recrawl,
+                    hostConcurrency=args.hostConcurrency, hostDelay=args.hostDelay, parseProcesses=args.parseProcesses, bulkLoad=args.bulkLoad,
+                    buildNgrams=args.buildNgrams, htmlParser=args.htmlParser, duplicateDistance=args.duplicateDistance)
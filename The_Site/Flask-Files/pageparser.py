@@ -0,0 +1,76 @@
+import hashlib
+from urllib.parse import urljoin
+from bs4 import BeautifulSoup, NavigableString, CData, Tag
+from bs4.builder import builder_registry
+from analyzer import Analyzer, loadStopwords
+from duplicates import minhash
+
+# the parse stage of the crawler - turning a fetched page into everything the indexer stores for it
+# it is pure cpu work with no database access, so the fetch pipeline can run it in a pool of processes (one analyzer per process)
+
+# stopword set, imported from a .txt file, and the analyzer (tokenizer, stopword filter, and cached stemmer) used for every page
+stopwords = loadStopwords('stopwords.txt')
+analyzer = Analyzer(stopwords)
+
+# the html parsers beautifulsoup can build the page trees with, of those that are installed - lxml's is written in c and faster
+# than python's own html.parser (which is pathologically slow on some large pages), so it is used whenever it is installed
+htmlParsers = [parser for parser in ['lxml', 'html.parser'] if builder_registry.lookup(parser) is not None]
+defaultHtmlParser = htmlParsers[0]
+
+# only these types of strings are the page's text (the others are comments, doctypes, and the contents of scripts, styles and templates)
+textTypes = (NavigableString, CData)
+
+# function to parse a page, returning its (title, text, links, hash, minhash signature, title postings, content postings)
+# the links are absolute but not yet canonicalized, the signature is of the content's stems (see duplicates.py), and the postings are built by buildPostings
+def parsePage(url, pageSource, htmlParser=defaultHtmlParser):
+    soup = BeautifulSoup(pageSource, htmlParser)
+    titleTag, text, links = extractPage(soup)
+    if titleTag is not None and titleTag.string is not None and titleTag.string.strip() != "":
+        title = str(titleTag.string)
+    else:
+        title = "No Title Given"
+    hash = hashText(text)
+
+    # if any link within links is a relative link, we need to make it absolute
+    # use the current url as the base with urljoin and replace the link in links
+    for i in range(len(links)):
+        if not links[i].startswith("http"):
+            links[i] = urljoin(url, links[i])
+
+    # tokenize, remove stopwords, and stem the title and content
+    titleStems, contentStems = analyzer.analyzeMany([title, text])
+
+    # build every term's position list in a single pass over the stems (frequency is the list's length)
+    return title, text, links, hash, minhash(contentStems), buildPostings(titleStems), buildPostings(contentStems)
+
+# function to pull the title tag, the text (like soup.get_text()), and the links (every <a>'s href, in order) out of a page in one walk over its tree
+def extractPage(soup):
+    titleTag = None
+    strings = []
+    links = []
+    for element in soup.descendants:
+        if type(element) in textTypes:
+            strings.append(element)
+        elif isinstance(element, Tag):
+            if element.name == 'a':
+                href = element.get('href')
+                # previously checked for href.startswith("http") but this was causing issues with relative links
+                if href is not None:
+                    links.append(href)
+            elif element.name == 'title' and titleTag is None:
+                titleTag = element
+    return titleTag, ''.join(strings), links
+
+# function to hash pages for later comparison (Reserved for page to page in database comparison in the future, like for page updates)
+# the hash is of the page's text with its whitespace normalized, so it ignores changes to the markup, scripts, and styles
+def hashText(text):
+    page_content = ' '.join(text.split())
+    return hashlib.sha256(page_content.encode('utf-8')).hexdigest()
+
+# function to build the positional postings for a list of stems in one pass
+# returns (stem, positions) tuples ordered like Counter.most_common() - by frequency, ties in order of first appearance
+def buildPostings(stems):
+    postings = {}
+    for position, stem in enumerate(stems):
+        postings.setdefault(stem, []).append(position)
+    return sorted(postings.items(), key=lambda posting: len(posting[1]), reverse=True)
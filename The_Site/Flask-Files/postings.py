@@ -0,0 +1,48 @@
+# the storage format of the position lists (TitleTermPosition and ContentTermPosition), shared by the crawler and the search api
+# (the search api has its own copy of this file, keep the two the same so the positions are read like they were written)
+
+# a position list is stored as the gaps between its (ascending) positions, the first counting from 0
+# each gap is a variable length integer - 7 bits per byte, low bits first, with the top bit set on every byte but the last
+# so most positions take a single byte
+
+# function to encode an ascending list of positions into its binary form
+def encodePositions(positions):
+    data = bytearray()
+    previous = 0
+    for position in positions:
+        gap = position - previous
+        previous = position
+        while gap >= 0x80:
+            data.append((gap & 0x7f) | 0x80)
+            gap >>= 7
+        data.append(gap)
+    return bytes(data)
+
+# function to decode a stored position list back into the list of positions
+# position lists stored by older crawlers are text (comma separated integers), which are read too
+def decodePositions(data):
+    if isinstance(data, str):
+        return [int(position) for position in data.split(',')]
+    positions = []
+    position = 0
+    gap = 0
+    shift = 0
+    for byte in data:
+        gap |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            position += gap
+            positions.append(position)
+            gap = 0
+            shift = 0
+    return positions
+
+# function to check if a phrase occurs on a page, given the position lists of the phrase's terms (in phrase order)
+# it does if there is a position of the first term with each of the following terms at the positions right after it
+def containsPhrase(positionLists):
+    following = [set(positions) for positions in positionLists[1:]]
+    for start in positionLists[0]:
+        if all(start + offset in positions for offset, positions in enumerate(following, 1)):
+            return True
+    return False
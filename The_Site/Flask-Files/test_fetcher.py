@@ -0,0 +1,224 @@
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import pytest
+from fetcher import FetchPipeline
+
+# tests of the fetch pipeline against a local http fixture server (no network, and a stand-in for the browser)
+
+# the pages the fixture server serves, by path (anything else, robots.txt included, is a 404)
+staticText = ' '.join('word' + str(i) for i in range(30))
+fixturePages = {
+    '/a.html': '<html><head><title>A</title></head><body><p>' + staticText + ' a</p></body></html>',
+    '/b.html': '<html><head><title>B</title></head><body><p>' + staticText + ' b</p></body></html>',
+    '/c.html': '<html><head><title>C</title></head><body><p>' + staticText + ' c</p></body></html>',
+    '/d.html': '<html><head><title>D</title></head><body><p>' + staticText + ' d</p></body></html>',
+    '/e.html': '<html><head><title>E</title></head><body><p>' + staticText + ' e</p></body></html>',
+    '/app.html': '<html><head><script src="app.js"></script></head><body><div id="root"></div></body></html>',
+    '/short.html': '<html><head><script>var x = 1;</script></head><body><p>just a short page</p></body></html>',
+    '/cafe.html': '<html><head><meta charset="utf-8"><title>Caf\u00e9 na\u00efve</title></head><body><p>' + staticText + '</p></body></html>',
+    '/cafe-latin.html': '<html><head><meta http-equiv="Content-Type" content="text/html; charset=iso-8859-1"><title>Caf\u00e9 na\u00efve</title></head>'
+                        '<body><p>' + staticText + '</p></body></html>',
+}
+# the pages served without a charset in their Content-Type header, and the encoding their bodies are in
+undeclaredCharsets = {'/cafe.html': 'utf-8', '/cafe-latin.html': 'iso-8859-1'}
+# the pages the server takes a while to answer, so the fetches of them overlap
+slowPages = ['/slow' + str(i) + '.html' for i in range(6)]
+for path in slowPages:
+    fixturePages[path] = '<html><head><title>Slow</title></head><body><p>' + staticText + '</p></body></html>'
+
+
+# the server logs the path and start time of every request, and counts the most requests it was answering at once
+class FixtureHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append((self.path, time.monotonic()))
+            server.active += 1
+            server.mostActive = max(server.mostActive, server.active)
+        try:
+            self.respond()
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def respond(self):
+        page = fixturePages.get(self.path)
+        if page is None:
+            self.send_error(404)
+            return
+        if self.path in slowPages:
+            time.sleep(0.2)
+        if self.path in undeclaredCharsets:
+            body = page.encode(undeclaredCharsets[self.path])
+            contentType = 'text/html'
+        else:
+            body = page.encode('utf-8')
+            contentType = 'text/html; charset=utf-8'
+        self.send_response(200)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+# a stand-in for a selenium webdriver, "rendering" a page as its url
+class FakeDriver:
+    def __init__(self):
+        self.urls = []
+        self.closed = False
+
+    def get(self, url):
+        self.urls.append(url)
+        self.page_source = '<html><body>rendered ' + url + '</body></html>'
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def httpd():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), FixtureHandler)
+    httpd.lock = threading.Lock()
+    httpd.requests = []
+    httpd.active = 0
+    httpd.mostActive = 0
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def server(httpd):
+    return 'http://127.0.0.1:' + str(httpd.server_address[1])
+
+
+@pytest.fixture
+def drivers():
+    return []
+
+
+@pytest.fixture
+def makeDriver(drivers):
+    def make():
+        driver = FakeDriver()
+        drivers.append(driver)
+        return driver
+    return make
+
+# the pages come back out of get() in the order asked for, however the workers finished them
+def testGetOrder(server, makeDriver, drivers):
+    pipeline = FetchPipeline(makeDriver, workers=3, hostConcurrency=3)
+    urls = [server + path for path in ['/c.html', '/a.html', '/e.html', '/b.html', '/d.html']]
+    pipeline.prefetch(urls, lambda url: False, len(urls))
+    try:
+        for url in urls:
+            pageSource, lastModified, etag, parsed = pipeline.get(url)
+            assert pageSource == fixturePages[url[len(server):]]
+            assert lastModified is not None
+            assert parsed is None
+    finally:
+        pipeline.close()
+    # static pages never start a browser
+    assert drivers == []
+
+# no more than the window's worth of pages (or the limit, if it is smaller) is ever in flight, and visited urls are skipped
+def testWindowBound(server, makeDriver):
+    pipeline = FetchPipeline(makeDriver, workers=2, window=2)
+    urls = [server + path for path in ['/a.html', '/b.html', '/c.html', '/d.html', '/e.html']]
+    visited = {urls[0]}
+    try:
+        pipeline.prefetch(urls, visited.__contains__, len(urls))
+        assert list(pipeline.pending) == urls[1:3]
+        # a full window isn't topped up until pages are taken out of it
+        pipeline.prefetch(urls, visited.__contains__, len(urls))
+        assert len(pipeline.pending) == 2
+        assert pipeline.get(urls[1]) is not None
+        visited.add(urls[1])
+        pipeline.prefetch(urls, visited.__contains__, 1)
+        assert list(pipeline.pending) == urls[2:3]
+        pipeline.prefetch(urls, visited.__contains__, len(urls))
+        assert list(pipeline.pending) == urls[2:4]
+    finally:
+        pipeline.close()
+
+# a page that needs javascript is handed to the worker's browser, and missing or robots-less pages are handled
+def testBrowserAndMissingPages(server, makeDriver, drivers):
+    pipeline = FetchPipeline(makeDriver, workers=1)
+    try:
+        pageSource, lastModified, etag, parsed = pipeline.get(server + '/app.html')
+        assert pageSource == '<html><body>rendered ' + server + '/app.html</body></html>'
+        assert pipeline.get(server + '/missing.html') is None
+        # the seed check keeps the page for get(), so it is only fetched once
+        assert pipeline.check(server + '/a.html') is not None
+        assert server + '/a.html' in pipeline.pending
+        assert pipeline.get(server + '/a.html')[0] == fixturePages['/a.html']
+    finally:
+        pipeline.close()
+    assert len(drivers) == 1 and drivers[0].urls == [server + '/app.html']
+    assert drivers[0].closed
+
+# a page the browser fails to render is kept as the http GET returned it, rather than dropped
+def testBrowserFailureFallsBack(server):
+    def makeDriver():
+        raise Exception("no browser here")
+    pipeline = FetchPipeline(makeDriver, workers=1)
+    try:
+        assert pipeline.check(server + '/short.html')[0] == fixturePages['/short.html']
+        assert pipeline.get(server + '/app.html')[0] == fixturePages['/app.html']
+    finally:
+        pipeline.close()
+
+# a page served without a charset in its Content-Type header is decoded with the charset its html declares
+def testMetaCharset(server, makeDriver):
+    pipeline = FetchPipeline(makeDriver, workers=1)
+    try:
+        for path in undeclaredCharsets:
+            pageSource = pipeline.get(server + path)[0]
+            assert pageSource == fixturePages[path]
+            assert 'Caf\u00e9 na\u00efve' in pageSource
+    finally:
+        pipeline.close()
+
+# pages disallowed by the host's robots.txt are skipped without being requested
+def testRobotsDisallow(server, httpd, makeDriver, monkeypatch):
+    monkeypatch.setitem(fixturePages, '/robots.txt', 'User-agent: *\nDisallow: /b.html\n')
+    pipeline = FetchPipeline(makeDriver, workers=2)
+    try:
+        assert pipeline.get(server + '/b.html') is None
+        assert pipeline.get(server + '/a.html')[0] == fixturePages['/a.html']
+    finally:
+        pipeline.close()
+    assert [path for path, start in httpd.requests] == ['/robots.txt', '/a.html']
+
+# no more than hostConcurrency pages are fetched from a host at once, however many workers are free
+def testHostConcurrency(server, httpd, makeDriver):
+    pipeline = FetchPipeline(makeDriver, workers=4, hostConcurrency=2)
+    urls = [server + path for path in slowPages]
+    try:
+        pipeline.prefetch(urls, lambda url: False, len(urls))
+        for url in urls:
+            assert pipeline.get(url) is not None
+    finally:
+        pipeline.close()
+    assert httpd.mostActive == 2
+
+# the fetches from a host are spaced out by its robots.txt crawl delay, from its very first pages on
+# (python's robots.txt parser only reads whole second crawl delays)
+def testCrawlDelay(server, httpd, makeDriver, monkeypatch):
+    monkeypatch.setitem(fixturePages, '/robots.txt', 'User-agent: *\nCrawl-delay: 1\n')
+    pipeline = FetchPipeline(makeDriver, workers=3, hostConcurrency=3)
+    urls = [server + path for path in ['/a.html', '/b.html', '/c.html']]
+    try:
+        pipeline.prefetch(urls, lambda url: False, len(urls))
+        for url in urls:
+            assert pipeline.get(url) is not None
+    finally:
+        pipeline.close()
+    starts = [start for path, start in httpd.requests if path != '/robots.txt']
+    assert len(starts) == 3
+    assert all(later - earlier >= 0.95 for earlier, later in zip(starts, starts[1:]))
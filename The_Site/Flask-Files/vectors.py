@@ -0,0 +1,36 @@
+import json
+import numpy as np
+
+# the storage format of the PageVectors, shared by the crawler and the search api
+# (the search api has its own copy of this file, keep the format the same in both so the vectors are read like they were written
+# - only this copy reads the JSON vectors of older crawlers, which upgradeDatabase re-encodes before the api can load them)
+
+# a vector is stored sparsely, as the int32 indices (term_id - 1) of its nonzero weights followed by the float32 weights
+# themselves, both little endian - so a page only takes 8 bytes per distinct term on it, and an empty vector takes none
+indexType = np.dtype('<i4')
+weightType = np.dtype('<f4')
+
+# function to encode a sparse vector, given as the arrays of its nonzero indices and their weights, into its binary form
+def encodeVector(indices, weights):
+    return np.asarray(indices, indexType).tobytes() + np.asarray(weights, weightType).tobytes()
+
+# function to get the norm of a sparse vector's weights, as they are stored
+def vectorNorm(weights):
+    weights = np.asarray(weights, weightType).astype(np.float64)
+    return float(np.sqrt(np.dot(weights, weights)))
+
+# function to decode a stored vector into its (indices, weights) arrays
+# vectors stored by older crawlers are dense JSON lists, which are decoded into the same sparse form
+# (they were json.dumps()ed into a JSON column, so they are usually encoded twice)
+def decodeVector(stored):
+    if isinstance(stored, str):
+        vector = json.loads(stored)
+        if isinstance(vector, str):
+            vector = json.loads(vector)
+        vector = np.array(vector)
+        indices = np.flatnonzero(vector)
+        return indices.astype(indexType), vector[indices].astype(weightType)
+    length = len(stored) // (indexType.itemsize + weightType.itemsize)
+    indices = np.frombuffer(stored, indexType, length)
+    weights = np.frombuffer(stored, weightType, length, indexType.itemsize * length)
+    return indices, weights